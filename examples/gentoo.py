@@ -12,7 +12,6 @@ def get_make_conf(system_version='0.0', **keywds):
         VIDEO_CARDS="vesa"
         USE_ORDER="pkg:env:pkginternal:conf:defaults:env.d"
         FEATURES="nodoc noinfo noman parallel-fetch"
-        EMERGE_DEFAULT_OPTS="--jobs --load-average=8"
         USE="bash-completion vim-syntax caps xcb"
         ACCEPT_LICENS="*"
 
@@ -60,7 +59,7 @@ def main():
     if '-f' in sys.argv:
         resume = False
     i = inhibitor.Inhibitor(paths={'share':top_dir})
-    s = inhibitor.Stage4(stageconf, 'example', resume=resume)
+    s = inhibitor.Stage4(stageconf, 'example', resume=resume, unified_merge=True)
     i.add_action(s)
     i.run()
 
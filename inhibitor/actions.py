@@ -1,58 +1,217 @@
 import os
 import shutil
 import util
+import archive
+import locks
 import glob
-import tarfile
 import types
+import cPickle
 
 class InhibitorAction(object):
     """
     Basic action.  Handles running through the action_sequence and catching
     errors that can be passed back up in order to do cleaning first.
 
-    @param name     - String representing this action
-    @param resume   - Allow the action sequence to resume where it left off it
-                      it was previously interrupted.
+    Each step of the action sequence gets a fingerprint of its inputs, made from
+    fingerprint_inputs(), step_inputs() and the fingerprint of the step before
+    it.  The fingerprints of completed steps are kept in the state directory and
+    when resuming, a step whose fingerprint has not changed since it last
+    completed is skipped.  Changing an input therefore re-runs the first step
+    that uses it and everything after it.
+
+    Actions that can checkpoint their output do so after the steps marked as
+    checkpoints, so that a resumed run does not build on output left behind
+    by a step that failed or changed.
+
+    @param name         - String representing this action
+    @param resume       - Skip steps whose inputs have not changed since they
+                          last completed, otherwise every step is run.
+    @param compression  - Compression of the archives the action creates, one
+                          of archive.COMPRESSION (bzip2).
     """
-    def __init__(self, name='BlankAction', resume=False):
+    def __init__(self, name='BlankAction', resume=False, compression='bzip2'):
+        archive.check_compression(compression)
         self.name               = name
         self.action_sequence    = []
         self.resume             = resume
+        self.compression        = compression
         self.statedir           = None
         self.istate             = None
+        # Names of the steps that are not always run which this run of the
+        # action runs, set by run() before the first step.
+        self.pending_steps      = set()
 
     def get_action_sequence(self):
         return []
 
+    def dependencies(self):
+        """Return the actions whose output this action uses."""
+        return []
+
+    def mount_roots(self, istate):
+        """
+        Return the directories the action mounts filesystems under, so that
+        they can be unmounted if the process running it is killed.  This only
+        depends on the configuration as the action may have run in another
+        process.
+        """
+        return []
+
+    def identity(self):
+        return [self.__class__.__name__, self.name]
+
+    def fingerprint_inputs(self, exclude):
+        """
+        Return the inputs shared by every step of the action.  exclude is the
+        set of conf keys the steps list as their own inputs.
+        """
+        return [self.identity(), self.compression]
+
+    def step_inputs(self, step):
+        """Return the inputs used by step alone."""
+        return []
+
+    def resume_valid(self):
+        """Return False if the output of earlier runs is gone."""
+        return True
+
     def post_conf(self, inhibitor_state):
         self.istate     = inhibitor_state
         self.statedir   = inhibitor_state.paths.state.pjoin(self.name)
-        if os.path.isdir(self.statedir) and not self.resume:
+        util.mkdir(self.statedir)
+        # The state and build directories of the action are its own, another
+        # process building an action of the same name has to wait.
+        locks.Lock(self.statedir.pjoin('lock')).acquire()
+        if not self.resume:
             self.clear_resume()
-            os.makedirs(self.statedir)
-        elif not os.path.exists(self.statedir):
-            os.makedirs(self.statedir)
-            self.resume = False
-        elif len(os.listdir(self.statedir)) == 0:
-            self.resume = False
+
+    def save_checkpoint(self, fingerprint, keep):
+        """
+        Checkpoint the output of the action after a step marked as a checkpoint
+        has run, under the fingerprint of the step.  Checkpoints whose
+        fingerprint is not in keep are no longer useful and may be dropped.
+        Actions without output to checkpoint do nothing.
+        """
+        pass
+
+    def load_checkpoint(self, fingerprint):
+        """
+        Put back the output saved by save_checkpoint() under fingerprint.
+        Returns False if there is no such checkpoint.
+        """
+        return False
+
+    def restart_point(self, steps, fingerprints, done):
+        """
+        Return the completed steps to resume with.  The first step that must
+        run again may have failed part way through or have changed, and the
+        steps after it built on its old output, so the output is rolled back to
+        the latest checkpoint before it and the steps following the checkpoint
+        are run again.  Without a checkpoint, done is returned as is.
+        """
+        first = None
+        for i, step in enumerate(steps):
+            if not step.always and done.get(step.name) != fingerprints[i]:
+                first = i
+                break
+        if first == None:
+            return done
+
+        for i in range(first - 1, -1, -1):
+            if not steps[i].checkpoint or done.get(steps[i].name) != fingerprints[i]:
+                continue
+            if self.load_checkpoint(fingerprints[i]):
+                util.info("Restarting from the checkpoint after %s" % steps[i].name)
+                return dict((s.name, fp) for s, fp in zip(steps[:i+1], fingerprints[:i+1]))
+        return done
 
     def run(self):
-        for action in self.get_action_sequence():
-            resume_path = self.statedir.pjoin('resume-%s-%s' % (self.name, action.name))
-            if ( self.resume
-                    and action.always == False
-                    and os.path.exists(resume_path) ):
+        steps = self.get_action_sequence()
+        exclude = set()
+        for step in steps:
+            exclude.update(step.conf_keys)
+
+        fingerprint = util.fingerprint(self.fingerprint_inputs(exclude))
+        fingerprints = []
+        for step in steps:
+            fingerprint = util.fingerprint(fingerprint, step.name, self.step_inputs(step))
+            fingerprints.append(fingerprint)
+
+        done = {}
+        if self.resume and self.resume_valid():
+            done = self.restart_point(steps, fingerprints,
+                load_fingerprints(self.statedir))
+
+        self.pending_steps = set()
+        for step, step_fingerprint in zip(steps, fingerprints):
+            if step.always:
                 continue
-            # Errors are caught by Inhibitor()
-            util.info("Running %s" % action.name)
-            action.run()
-            open(resume_path, 'w').close()
-        self.clear_resume()
+            if len(self.pending_steps) > 0 or done.get(step.name) != step_fingerprint:
+                self.pending_steps.add(step.name)
+
+        completed = {}
+        for step, step_fingerprint in zip(steps, fingerprints):
+            if not step.always and done.get(step.name) == step_fingerprint:
+                util.dbg("Skipping %s, its inputs have not changed" % step.name)
+            else:
+                if not step.always:
+                    # The steps after this one now build on its new output.
+                    done = {}
+                    save_fingerprints(self.statedir, completed)
+                # Errors are caught by Inhibitor()
+                util.info("Running %s" % step.name)
+                self.istate.acquire(step.resource)
+                try:
+                    step.run()
+                finally:
+                    self.istate.release(step.resource)
+                if step.checkpoint:
+                    self.save_checkpoint(step_fingerprint, fingerprints)
+            completed[step.name] = step_fingerprint
+            save_fingerprints(self.statedir, completed, done)
+        save_fingerprints(self.statedir, completed, final=fingerprint)
 
     def clear_resume(self):
-        for f in glob.iglob(self.statedir.pjoin('resume-%s-*' % self.name)):
-            os.unlink(f)
-        os.rmdir(self.statedir)
+        path = self.statedir.pjoin('fingerprints')
+        if os.path.exists(path):
+            os.unlink(path)
+
+def load_fingerprints(statedir):
+    """
+    Return the step fingerprints saved in statedir.  The fingerprint of the
+    whole action, if it completed, is stored under None.
+    """
+    path = util.Path(statedir).pjoin('fingerprints')
+    if not os.path.exists(path):
+        return {}
+    f = open(path, 'rb')
+    try:
+        try:
+            return cPickle.load(f)
+        except (EOFError, cPickle.UnpicklingError):
+            util.warn("Ignoring corrupt %s" % (path,))
+            return {}
+    finally:
+        f.close()
+
+def save_fingerprints(statedir, completed, pending={}, final=None):
+    """
+    Save the fingerprints of completed steps to statedir.  Those in pending
+    are kept if they are not replaced by completed, so that an interrupted run
+    can still skip the steps it did not reach.
+    """
+    fingerprints = dict(pending)
+    fingerprints.pop(None, None)
+    fingerprints.update(completed)
+    if final != None:
+        fingerprints[None] = final
+
+    path = util.Path(statedir).pjoin('fingerprints')
+    tmp = locks.temp_path(path)
+    f = open(tmp, 'wb')
+    cPickle.dump(fingerprints, f, 2)
+    f.close()
+    locks.publish(tmp, path)
 
 
 class InhibitorSnapshot(InhibitorAction):
@@ -65,9 +224,11 @@ class InhibitorSnapshot(InhibitorAction):
                               the snapshot.  Passed to rsync --exclude.
     @param include          - String, passed to glob, of toplevel paths to include
                               in the snapshot.
+    @param compression      - Compression of the snapshot, one of
+                              archive.COMPRESSION (bzip2).
     """
-    def __init__(self, snapshot_source, name, exclude=None, include=None):
-        super(InhibitorSnapshot, self).__init__(name='snapshot')
+    def __init__(self, snapshot_source, name, exclude=None, include=None, compression='bzip2'):
+        super(InhibitorSnapshot, self).__init__(name='snapshot', compression=compression)
         self.dest       = None
         self.builddir   = None
         self.tarname    = None
@@ -98,10 +259,15 @@ class InhibitorSnapshot(InhibitorAction):
         else:
             self.include = False
 
+    def fingerprint_inputs(self, exclude):
+        return super(InhibitorSnapshot, self).fingerprint_inputs(exclude) + [
+            self.src, self.exclude, self.include]
+
     def get_action_sequence(self):
         return [
-            util.Step(self.sync,     always=False),
-            util.Step(self.pack,     always=False),
+            util.Step(self.sync,     always=False, resource='io'),
+            util.Step(self.pack,     always=False, resource='io'),
+            util.Step(self.finish_source, always=True),
         ]
 
     def post_conf(self, inhibitor_state):
@@ -110,7 +276,8 @@ class InhibitorSnapshot(InhibitorAction):
         self.src.init()
 
         self.tarname    = 'snapshot-' + self.name
-        self.dest       = inhibitor_state.paths.stages.pjoin(self.tarname+'.tar.bz2')
+        self.dest       = archive.tarpath(
+            inhibitor_state.paths.stages.pjoin(self.tarname), self.compression)
         self.builddir   = inhibitor_state.paths.build.pjoin(self.tarname)
 
     def sync(self):
@@ -144,14 +311,12 @@ class InhibitorSnapshot(InhibitorAction):
             util.cmd('rsync -a %s %s/ %s/' % (exclude_cmd, self.src.cachedir, self.builddir))
 
     def pack(self):
-        archive = tarfile.open(self.dest, 'w:bz2')
-        archive.add(self.builddir,
-            arcname = '/',
-            recursive = True
-        )
-        archive.close()
+        archive.pack_tree(self.builddir, self.dest, self.compression)
         util.info('%s is ready.' % self.dest)
 
+    def finish_source(self):
+        self.src.finish()
+
     def get_snappath(self):
         if self.dest:
             return self.dest
@@ -0,0 +1,486 @@
+import os
+import bz2
+import grp
+import pwd
+import stat
+import gzip
+import tarfile
+import subprocess
+
+import locks
+import util
+
+# Compression formats supported for archives.  Each maps to the archive
+# extension and the programs that can handle it, in order of preference.  The
+# programs split their input into blocks and compress them on all cpus while
+# still writing a standard stream that any tar can extract.  The xz checksum
+# and lz4 frame format are the ones the kernel can unpack an initramfs from.
+COMPRESSION = {
+    'bzip2':    ('bz2', (('lbzip2',), ('pbzip2',), ('bzip2',))),
+    'gzip':     ('gz',  (('pigz', '-9'), ('gzip', '-9'))),
+    'lz4':      ('lz4', (('lz4', '-q', '-l'),)),
+    'xz':       ('xz',  (('xz', '-T0', '--check=crc32'),)),
+    'zstd':     ('zst', (('zstd', '-q', '-T0'),)),
+}
+
+def check_compression(compression):
+    """Raise an InhibitorError if compression is not supported."""
+    if not compression in COMPRESSION:
+        raise util.InhibitorError("Unknown compression '%s', expected one of %s"
+            % (compression, ', '.join(sorted(COMPRESSION.keys()))))
+
+def tarpath(base, compression='bzip2'):
+    """Return the path of the archive for base compressed with compression."""
+    check_compression(compression)
+    return util.Path('%s.tar.%s' % (base, COMPRESSION[compression][0]))
+
+def find_tarball(base):
+    """
+    Return the path of an existing archive for base in any supported
+    compression, or None if there is none.  Packing the stage again with
+    another compression leaves the old archive behind, so the most recently
+    modified one is returned.
+    """
+    found = []
+    for compression in sorted(COMPRESSION.keys()):
+        path = tarpath(base, compression)
+        if os.path.exists(path):
+            found.append((os.stat(path).st_mtime, path))
+    if len(found) == 0:
+        return None
+    if len(found) > 1:
+        util.dbg("Using %s, the newest of %s" % (max(found)[1],
+            ', '.join([p for _, p in found])))
+    return max(found)[1]
+
+def compression_of(path):
+    """Return the compression of the archive at path, going by its extension."""
+    for compression, (ext, _) in COMPRESSION.items():
+        if path.endswith('.tar.' + ext):
+            return compression
+    raise util.InhibitorError("Unknown compression for %s" % (path,))
+
+def compressor(compression):
+    """
+    Return the argument list of the preferred compression program installed
+    for compression or None if none of them are.
+    """
+    check_compression(compression)
+    for args in COMPRESSION[compression][1]:
+        if util.which(args[0]):
+            return list(args)
+    return None
+
+def extract_cmd(path, dest):
+    """Return a command line that extracts the archive at path into dest."""
+    args = compressor(compression_of(path))
+    if args == None:
+        return 'tar -xapf %s -C %s/' % (path, dest)
+    return "tar -I '%s' -xpf %s -C %s/" % (' '.join(args), path, dest)
+
+
+# Size of the reads used to copy file data into archives.
+READ_SIZE = 1024 * 1024
+
+class TarStream(object):
+    """
+    Write a tar archive to a file object one member at a time.  Unlike tarfile
+    no TarInfo is kept for members already written, the only state that grows
+    with the archive is the first name of each file with more than one link so
+    that later links to it are stored as hard links.  User and group names are
+    looked up once per id.
+
+    The archive is byte for byte what tarfile.open(mode='w|') would write
+    when given the same members.
+
+    @param fileobj  - File object to write the archive to.
+    """
+    def __init__(self, fileobj):
+        self.fileobj    = fileobj
+        self.offset     = 0
+        self.size       = 0
+        self.links      = {}
+        self.unames     = {}
+        self.gnames     = {}
+
+    def _uname(self, uid):
+        if not uid in self.unames:
+            try:
+                self.unames[uid] = pwd.getpwuid(uid)[0]
+            except KeyError:
+                self.unames[uid] = ''
+        return self.unames[uid]
+
+    def _gname(self, gid):
+        if not gid in self.gnames:
+            try:
+                self.gnames[gid] = grp.getgrgid(gid)[0]
+            except KeyError:
+                self.gnames[gid] = ''
+        return self.gnames[gid]
+
+    def tarinfo(self, path, arcname, st):
+        """
+        Return the TarInfo for path with lstat result st, stored as arcname,
+        the same as tarfile.TarFile.gettarinfo() would.  Returns None for files
+        that cannot be archived, such as sockets.
+        """
+        arcname = arcname.replace(os.sep, '/').lstrip('/')
+        info = tarfile.TarInfo(arcname)
+        linkname = ''
+
+        mode = st.st_mode
+        if stat.S_ISREG(mode):
+            inode = (st.st_ino, st.st_dev)
+            if st.st_nlink > 1 and inode in self.links and self.links[inode] != arcname:
+                info.type = tarfile.LNKTYPE
+                linkname = self.links[inode]
+            else:
+                info.type = tarfile.REGTYPE
+                if st.st_nlink > 1 and inode[0]:
+                    self.links[inode] = arcname
+        elif stat.S_ISDIR(mode):
+            info.type = tarfile.DIRTYPE
+        elif stat.S_ISFIFO(mode):
+            info.type = tarfile.FIFOTYPE
+        elif stat.S_ISLNK(mode):
+            info.type = tarfile.SYMTYPE
+            linkname = os.readlink(path)
+        elif stat.S_ISCHR(mode):
+            info.type = tarfile.CHRTYPE
+        elif stat.S_ISBLK(mode):
+            info.type = tarfile.BLKTYPE
+        else:
+            return None
+
+        info.mode       = mode
+        info.uid        = st.st_uid
+        info.gid        = st.st_gid
+        if info.type == tarfile.REGTYPE:
+            info.size   = st.st_size
+        else:
+            info.size   = 0L
+        info.mtime      = st.st_mtime
+        info.linkname   = linkname
+        info.uname      = self._uname(st.st_uid)
+        info.gname      = self._gname(st.st_gid)
+        if info.type in (tarfile.CHRTYPE, tarfile.BLKTYPE):
+            info.devmajor = os.major(st.st_rdev)
+            info.devminor = os.minor(st.st_rdev)
+        return info
+
+    def begin(self, path, arcname, st):
+        """
+        Write the header for path with lstat result st, stored as arcname.
+        Returns True if the contents of path must follow, passed to write()
+        and then end().
+        """
+        info = self.tarinfo(path, arcname, st)
+        if info == None:
+            util.dbg("Not archiving %s, unsupported file type" % (path,))
+            return False
+
+        buf = info.tobuf(tarfile.DEFAULT_FORMAT, tarfile.ENCODING, 'strict')
+        self.fileobj.write(buf)
+        self.offset += len(buf)
+        self.size = info.size
+        return info.type == tarfile.REGTYPE
+
+    def write(self, data):
+        self.fileobj.write(data)
+
+    def end(self):
+        blocks, remainder = divmod(self.size, tarfile.BLOCKSIZE)
+        if remainder > 0:
+            self.fileobj.write(tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
+            blocks += 1
+        self.offset += blocks * tarfile.BLOCKSIZE
+
+    def close(self):
+        """Write the end of archive marker, the file object is left open."""
+        self.fileobj.write(tarfile.NUL * (tarfile.BLOCKSIZE * 2))
+        self.offset += tarfile.BLOCKSIZE * 2
+        blocks, remainder = divmod(self.offset, tarfile.RECORDSIZE)
+        if remainder > 0:
+            self.fileobj.write(tarfile.NUL * (tarfile.RECORDSIZE - remainder))
+
+class CpioStream(object):
+    """
+    Write a cpio archive in the SVR4 newc format, as used for initramfs
+    images, to a file object one member at a time.  Names are stored the way
+    'find . | cpio -H newc -o' stores them, relative to the top of the tree.
+
+    Like GNU cpio, the links to a file are stored together once all of them
+    have been seen, the contents following only the last one.  The kernel
+    links the earlier names to the first and writes the contents into the
+    file they share.  Links to files that are partly outside of the tree are
+    stored when the archive is closed.
+
+    @param fileobj  - File object to write the archive to.
+    """
+    def __init__(self, fileobj):
+        self.fileobj    = fileobj
+        self.offset     = 0
+        self.links      = {}
+
+    def _header(self, name, st, size):
+        self._entry(name, st.st_ino, st.st_mode, st.st_uid, st.st_gid,
+            st.st_nlink, st.st_mtime, size, st.st_dev, st.st_rdev)
+
+    def _entry(self, name, ino, mode, uid, gid, nlink, mtime, size, dev, rdev):
+        name += '\0'
+        self._write('070701%08x%08x%08x%08x%08x%08x%08x%08x%08x%08x%08x%08x%08x%s' % (
+            ino & 0xffffffff, mode, uid, gid, nlink, int(mtime) & 0xffffffff,
+            size, os.major(dev), os.minor(dev), os.major(rdev), os.minor(rdev),
+            len(name), 0, name))
+        self._pad()
+
+    def _write(self, data):
+        self.fileobj.write(data)
+        self.offset += len(data)
+
+    def _pad(self, align=4):
+        if self.offset % align:
+            self._write('\0' * (align - self.offset % align))
+
+    def begin(self, path, arcname, st):
+        """
+        Write the header for path with lstat result st, stored as arcname.
+        Returns True if the contents of path must follow, passed to write()
+        and then end().
+        """
+        name = arcname.replace(os.sep, '/').strip('/')
+        if name:
+            name = './' + name
+        else:
+            name = '.'
+
+        if stat.S_ISREG(st.st_mode):
+            if st.st_nlink > 1:
+                links = self.links.setdefault((st.st_dev, st.st_ino), [])
+                links.append((path, name, st))
+                if len(links) < st.st_nlink:
+                    return False
+                del self.links[(st.st_dev, st.st_ino)]
+                self._links(links)
+            else:
+                self._header(name, st, st.st_size)
+            return True
+        elif stat.S_ISLNK(st.st_mode):
+            target = os.readlink(path)
+            self._header(name, st, len(target))
+            self._write(target)
+            self._pad()
+        else:
+            self._header(name, st, 0)
+        return False
+
+    def _links(self, links):
+        """Write the headers of the (path, name, st) links to a file."""
+        for _, name, st in links[:-1]:
+            self._header(name, st, 0)
+        _, name, st = links[-1]
+        self._header(name, st, st.st_size)
+
+    def write(self, data):
+        self._write(data)
+
+    def end(self):
+        self._pad()
+
+    def close(self):
+        """
+        Write the links that are still missing some of theirs and the trailer,
+        the file object is left open.
+        """
+        for links in sorted(self.links.values(), key=lambda l: l[0][1]):
+            self._links(links)
+            path, _, st = links[-1]
+            f = open(path, 'rb')
+            try:
+                remaining = st.st_size
+                while remaining > 0:
+                    buf = f.read(min(remaining, READ_SIZE))
+                    if len(buf) == 0:
+                        raise IOError("end of file reached")
+                    self._write(buf)
+                    remaining -= len(buf)
+            finally:
+                f.close()
+            self.end()
+        self.links = {}
+        self._entry('TRAILER!!!', 0, 0, 0, 0, 1, 0, 0, 0, 0)
+        self._pad(512)
+
+STREAMS = {
+    'tar':  TarStream,
+    'cpio': CpioStream,
+}
+
+class _Bz2File(object):
+    """Write only file object compressing to fileobj with bzip2."""
+    def __init__(self, fileobj):
+        self.fileobj    = fileobj
+        self.comp       = bz2.BZ2Compressor(9)
+
+    def write(self, data):
+        self.fileobj.write(self.comp.compress(data))
+
+    def close(self):
+        self.fileobj.write(self.comp.flush())
+
+
+class ArchiveWriter(object):
+    """
+    Write a compressed archive, piping it through an external compressor so
+    that compression runs on every cpu in parallel with this process and any
+    other ArchiveWriter.  The archive is written next to path, under a name
+    unique to the process, and renamed into place on close so that a failed
+    pack never leaves a truncated archive behind and readers in other
+    processes never see a partial one.
+
+    If no compression program is installed for bzip2 or gzip, the archive is
+    compressed in this process instead.
+
+    @param path         - Path of the archive.
+    @param compression  - One of COMPRESSION (bzip2).
+    @param format       - One of STREAMS (tar).
+    """
+    def __init__(self, path, compression='bzip2', format='tar'):
+        self.path           = util.Path(path)
+        self.compression    = compression
+        self.tmppath        = locks.temp_path(self.path)
+        self.out            = None
+        self.proc           = None
+        self.stream         = None
+        self.archive        = None
+
+        if not format in STREAMS:
+            raise util.InhibitorError("Unknown archive format '%s'" % (format,))
+        args = compressor(compression)
+        self.out = open(self.tmppath, 'wb')
+        try:
+            if args != None:
+                util.dbg("Compressing %s with %s" % (self.path, ' '.join(args)))
+                self.proc = subprocess.Popen(args + ['-c'],
+                    stdin = subprocess.PIPE,
+                    stdout = self.out,
+                    bufsize = READ_SIZE,
+                    close_fds = True)
+                self.stream = self.proc.stdin
+            elif compression == 'bzip2':
+                self.stream = _Bz2File(self.out)
+            elif compression == 'gzip':
+                self.stream = gzip.GzipFile('', 'wb', 9, self.out)
+            else:
+                raise util.InhibitorError("No program found to compress %s with %s"
+                    % (self.path, compression))
+            self.archive = STREAMS[format](self.stream)
+        except:
+            self.abort()
+            raise
+
+    def begin(self, path, arcname, st):
+        return self.archive.begin(path, arcname, st)
+
+    def write(self, data):
+        self.archive.write(data)
+
+    def end(self):
+        self.archive.end()
+
+    def close(self):
+        """Finish the archive and move it into place."""
+        try:
+            self.archive.close()
+            self.stream.close()
+            if self.proc != None:
+                ret = self.proc.wait()
+                self.proc = None
+                if ret != 0:
+                    raise util.InhibitorError("Compressing %s failed with %d"
+                        % (self.path, ret))
+            self.out.close()
+            locks.publish(self.tmppath, self.path)
+        except:
+            self.abort()
+            raise
+
+    def abort(self):
+        """Stop writing the archive and remove what was written of it."""
+        if self.proc != None:
+            try:
+                self.proc.stdin.close()
+            except IOError:
+                pass
+            util._kill_pids(self.proc.pid)
+            self.proc = None
+        if self.out != None:
+            self.out.close()
+        if os.path.lexists(self.tmppath):
+            os.unlink(self.tmppath)
+
+def _add(archives, path, arcname, st):
+    """Add path to each of archives, reading its contents only once."""
+    readers = [a for a in archives if a.begin(path, arcname, st)]
+    if len(readers) == 0:
+        return
+
+    f = open(path, 'rb')
+    try:
+        remaining = st.st_size
+        while remaining > 0:
+            buf = f.read(min(remaining, READ_SIZE))
+            if len(buf) == 0:
+                raise IOError("end of file reached")
+            for a in readers:
+                a.write(buf)
+            remaining -= len(buf)
+    finally:
+        f.close()
+    for a in readers:
+        a.end()
+
+def add_tree(archives, path, arcname='/'):
+    """
+    Add path and everything below it to each of archives, walking the tree
+    and reading each file once for all of them.  Members are added in the same
+    order as tarfile.TarFile.add(path, arcname, recursive=True) would.
+
+    @param archives - List of TarStream, CpioStream or ArchiveWriter objects.
+    @param path     - Directory to add.
+    @param arcname  - Name of path inside the archives.
+    """
+    _add(archives, path, arcname, os.lstat(path))
+    prefix = len(path.rstrip('/')) + 1
+    for entry in util.walk(path):
+        _add(archives, entry.path,
+            os.path.join(arcname, entry.path[prefix:]),
+            entry.stat(follow_symlinks=False))
+
+def write_tree(path, writers):
+    """
+    Write path and everything below it to each of writers and close them, or
+    abort all of them on failure.
+
+    @param path     - Directory to archive.
+    @param writers  - List of ArchiveWriters.
+    """
+    try:
+        add_tree(writers, path)
+        for w in writers:
+            w.close()
+    except:
+        for w in writers:
+            w.abort()
+        raise
+
+def pack_tree(path, dest, compression='bzip2'):
+    """
+    Create the tar archive dest containing path and everything below it.
+
+    @param path         - Directory to archive.
+    @param dest         - Path of the archive.
+    @param compression  - One of COMPRESSION (bzip2).
+    """
+    write_tree(path, [ArchiveWriter(dest, compression)])
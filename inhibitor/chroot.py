@@ -0,0 +1,309 @@
+import os
+import sys
+import errno
+import fcntl
+import select
+import types
+import cPickle
+import cStringIO
+import itertools
+import threading
+import traceback
+
+import util
+
+# Counts the workers started, so that they can be stopped in reverse order.
+_started = itertools.count()
+
+def _close_fds(keep):
+    """Close every file descriptor above stderr except those in keep."""
+    try:
+        fds = [int(fd) for fd in os.listdir('/proc/self/fd')]
+    except OSError:
+        fds = range(3, os.sysconf('SC_OPEN_MAX'))
+    for fd in fds:
+        if fd > 2 and not fd in keep:
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+def _set_cloexec(fd):
+    fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+
+class ChrootWorker(object):
+    """
+    Helper process that chroots into a root once and then runs the functions it
+    is sent, sparing the main process a chroot, fchdir and unchroot for every
+    call and leaving its own root untouched so that it is safe to use threads.
+
+    Calls and their arguments are pickled over a pipe.  Functions and bound
+    methods are not pickled but referenced, the helper finds its own copy of
+    them as it was forked from this process.  If a call refers to a function or
+    object the helper was forked before seeing, the helper is restarted first.
+    Arguments and return values must otherwise be picklable.  Changes a call
+    makes to objects only happen to the helper's copy of them, anything the
+    caller needs back must be returned.
+
+    The helper closes every file descriptor it inherits other than its own
+    pipes, so that it never keeps another helper's pipes or a lock open.
+
+    @param root     - Root of the chroot.
+    """
+    def __init__(self, root):
+        self.root       = util.Path(root)
+        self.pid        = None
+        self.requests   = None
+        self.replies    = None
+        self.objects    = {}
+        self.forked     = set()
+        self.lock       = threading.Lock()
+        self.serial     = None
+        self.pending    = False
+
+    def _persistent_id(self, obj):
+        if type(obj) == types.MethodType and obj.im_self != None:
+            key = ('method', id(obj.im_self), obj.im_func.func_name)
+            self.objects[key] = obj.im_self
+            return cPickle.dumps(key, 2)
+        elif type(obj) in (types.FunctionType, types.MethodType, types.BuiltinFunctionType):
+            key = ('function', id(obj))
+            self.objects[key] = obj
+            return cPickle.dumps(key, 2)
+        return None
+
+    def _persistent_load(self, pid):
+        key = cPickle.loads(pid)
+        if key[0] == 'method':
+            return getattr(self.objects[key], key[2])
+        return self.objects[key]
+
+    def start(self):
+        """Fork the helper and chroot it into root."""
+        req_r, req_w = os.pipe()
+        rep_r, rep_w = os.pipe()
+        # Programs run by this process must not keep the helper's pipes open.
+        _set_cloexec(req_w)
+        _set_cloexec(rep_r)
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                _close_fds((req_r, rep_w))
+                code = self._serve(os.fdopen(req_r, 'rb'), os.fdopen(rep_w, 'wb'))
+            finally:
+                os._exit(code)
+
+        os.close(req_r)
+        os.close(rep_w)
+        self.pid        = pid
+        self.serial     = _started.next()
+        self.requests   = os.fdopen(req_w, 'wb')
+        self.replies    = os.fdopen(rep_r, 'rb')
+        self.forked     = set(self.objects.keys())
+
+        status, message = self._reply()
+        if status != 'ok':
+            self.stop()
+            raise util.InhibitorError("Cannot chroot to %s: %s" % (self.root, message))
+        util.dbg("Started chroot worker %d in %s" % (self.pid, self.root))
+
+    def _serve(self, requests, replies):
+        try:
+            os.chroot(self.root)
+            os.chdir('/')
+        except (IOError, OSError), e:
+            cPickle.dump(('error', str(e)), replies, 2)
+            replies.flush()
+            return 1
+        cPickle.dump(('ok', None), replies, 2)
+        replies.flush()
+
+        unpickler = cPickle.Unpickler(requests)
+        unpickler.persistent_load = self._persistent_load
+        while True:
+            try:
+                calls = unpickler.load()
+            except EOFError:
+                return 0
+
+            results = []
+            for function, fargs in calls:
+                try:
+                    results.append(('ok', function(**fargs)))
+                except (KeyboardInterrupt, SystemExit, Exception), e:
+                    message = ' '.join([str(a) for a in e.args]) or e.__class__.__name__
+                    results.append(('error', (message, traceback.format_exc())))
+                    break
+            sys.stdout.flush()
+
+            try:
+                data = cPickle.dumps(results, 2)
+            except (cPickle.PicklingError, TypeError):
+                data = cPickle.dumps(
+                    [(status, None) for status, _ in results[:-1]] + [results[-1]], 2)
+            replies.write(data)
+            replies.flush()
+
+    def _reply(self):
+        try:
+            return cPickle.load(self.replies)
+        except EOFError:
+            self.stop()
+            raise util.InhibitorError("Chroot worker for %s exited" % (self.root,))
+
+    def batch(self, calls):
+        """
+        Run each (function, fargs) pair in calls inside the chroot, stopping at
+        the first failure.  Returns a list of (status, value) pairs where status
+        is 'ok' and value is the return value of the function or status is
+        'error' and value is a pair of the exception message and traceback.
+        """
+        self.lock.acquire()
+        try:
+            self._send(calls)
+            return self._reply()
+        finally:
+            self.lock.release()
+
+    def submit(self, calls):
+        """
+        Send calls to the helper like batch() without waiting for them to
+        finish, collect() returns their results.
+        """
+        self.lock.acquire()
+        try:
+            self._send(calls)
+            self.pending = True
+        finally:
+            self.lock.release()
+
+    def ready(self):
+        """Return True if the calls sent by submit() have finished."""
+        ready, _, _ = select.select([self.replies], [], [], 0)
+        return len(ready) > 0
+
+    def collect(self, timeout=None):
+        """
+        Wait for the calls sent by submit() and return their results, see
+        batch().  Raises InhibitorError if they have not finished within timeout
+        seconds, leaving them running.
+        """
+        self.lock.acquire()
+        try:
+            while True:
+                try:
+                    ready, _, _ = select.select([self.replies], [], [], timeout)
+                    break
+                except select.error, e:
+                    if e.args[0] != errno.EINTR:
+                        raise
+            if not ready:
+                raise util.InhibitorError("Chroot worker for %s did not finish in %ds"
+                    % (self.root, timeout))
+            self.pending = False
+            return self._reply()
+        finally:
+            self.lock.release()
+
+    def _send(self, calls):
+        buf = cStringIO.StringIO()
+        pickler = cPickle.Pickler(buf, 2)
+        pickler.persistent_id = self._persistent_id
+        pickler.dump(calls)
+
+        if self.pending:
+            raise util.InhibitorError("Chroot worker for %s is busy" % (self.root,))
+        if self.pid != None and not set(self.objects.keys()).issubset(self.forked):
+            util.dbg("Restarting chroot worker for %s" % (self.root,))
+            self.stop()
+        if self.pid == None:
+            self.start()
+
+        sys.stdout.flush()
+        self.requests.write(buf.getvalue())
+        self.requests.flush()
+
+    def stop(self):
+        """
+        Stop the helper, waiting for it to exit.  A helper still running calls
+        sent by submit() is killed, along with every process chrooted into its
+        root.
+        """
+        if self.pid == None:
+            return
+        if self.pending:
+            root = os.path.realpath(self.root)
+            util._kill_pids([self.pid] + [pid
+                for pid, proot in util.proc_roots().items() if proot == root])
+            self.pending = False
+        self.requests.close()
+        self.replies.close()
+        try:
+            os.waitpid(self.pid, 0)
+        except OSError:
+            pass
+        util.dbg("Stopped chroot worker %d in %s" % (self.pid, self.root))
+        self.pid = None
+
+
+_workers = {}
+
+def get_worker(path):
+    """Return the ChrootWorker for path, creating it if needed."""
+    path = util.Path(path)
+    if not path in _workers:
+        _workers[path] = ChrootWorker(path)
+    return _workers[path]
+
+def stop_workers(path=None):
+    """
+    Stop the worker for path, or all workers if path is None, the most
+    recently started first.
+    """
+    if path == None:
+        paths = sorted(_workers.keys(), reverse=True,
+            key=lambda p: _workers[p].serial)
+    else:
+        paths = [util.Path(path)]
+    for p in paths:
+        if p in _workers:
+            _workers.pop(p).stop()
+
+def batch(path, calls, failuref=None, failure_args={}):
+    """
+    Run a list of functions inside of a chroot using a single ChrootWorker.
+
+    @param path             - Root of the chroot.
+    @param calls            - List of (function, fargs) pairs to run in order.
+    @param failuref         - Function to run on failure (None).
+    @param failure_args     - Arguments to pass to failure function ({})
+
+    Return is a list of the return value of each function.
+    """
+    if len(calls) == 0:
+        return []
+    results = get_worker(path).batch(calls)
+    if results[-1][0] == 'error':
+        message, tb = results[-1][1]
+        if failuref != None:
+            failuref(**failure_args)
+        util.dbg(tb)
+        raise util.InhibitorError("In chroot %s: %s" % (path, message))
+    return [value for _, value in results]
+
+def run(path, function, failuref=None, fargs={}, failure_args={}):
+    """
+    Run a function inside of a chroot.  A drop in replacement for util.chroot
+    using a ChrootWorker.
+
+    @param path             - Root of the chroot.
+    @param function         - Function to run.
+    @param failuref         - Function to run on failure (None).
+    @param fargs            - Arguments to pass to function ({}).
+    @param failure_args     - Arguments to pass to failure function ({})
+    """
+    return batch(path, [(function, fargs)], failuref, failure_args)[0]
@@ -2,9 +2,10 @@ import os
 import glob
 import re
 import magic
-import tarfile
 import shutil
 
+import archive
+import chroot
 import stage
 import util
 import source
@@ -14,8 +15,11 @@ class EmbeddedStage(stage.BaseGentooStage):
     Create an Embedded Stage, essentially a stage4 based on busybox providing the majority
     of the required functionality.
 
-    @param stage_conf   - Stage configuration, details below.
-    @param build_name   - Unique string to identify the stage.
+    @param stage_conf               - Stage configuration, details below.
+    @param build_name               - Unique string to identify the stage.
+    @param initramfs_compression    - Compression of the initramfs, one of
+                                      archive.COMPRESSION the kernel can unpack
+                                      (gzip).
 
     Stage Configuration:
     @param name         - Should match the build_name.
@@ -30,7 +34,10 @@ class EmbeddedStage(stage.BaseGentooStage):
                           kernel has been configured.
     @param profile      - Portage profile to use.
     @param seed         - Name of the seed stage to use for building.  Stage
-                          needs to be located in inhibitor's stagedir.
+                          needs to be located in inhibitor's stagedir.  May
+                          also be another BaseStage that has already run, in
+                          which case its finished root is used directly.
+    @param pack         - Pack the finished images and kernel (True).
     @param package_list - String or List of packages to install to
                           the working stage3.
     @param make_conf    - InhibitorSource for make.conf.
@@ -43,7 +50,9 @@ class EmbeddedStage(stage.BaseGentooStage):
                           embedded stage automatically.
     """
 
-    def __init__(self, stage_conf, build_name, **keywds):
+    def __init__(self, stage_conf, build_name, initramfs_compression='gzip', **keywds):
+        archive.check_compression(initramfs_compression)
+        self.initramfs_compression = initramfs_compression
         self.seed           = None
         self.tarpath        = None
         self.cpiopath       = None
@@ -86,8 +95,10 @@ class EmbeddedStage(stage.BaseGentooStage):
 
         super(EmbeddedStage, self).post_conf(inhibitor_state)
         self.moduledir      = self.istate.paths.share.pjoin('early-userspace/modules')
-        self.tarpath        = self.istate.paths.stages.pjoin('%s/image.tar.bz2' % (self.build_name,))
-        self.cpiopath       = self.istate.paths.stages.pjoin('%s/initramfs.gz' % (self.build_name,))
+        self.tarpath        = archive.tarpath(
+            self.istate.paths.stages.pjoin('%s/image' % (self.build_name,)), self.compression)
+        self.cpiopath       = self.istate.paths.stages.pjoin('%s/initramfs.%s' % (
+            self.build_name, archive.COMPRESSION[self.initramfs_compression][0]))
         self.kernlinkpath   = self.istate.paths.stages.pjoin('%s/kernel' % (self.build_name,))
 
         if self.conf.has('files'):
@@ -118,23 +129,42 @@ class EmbeddedStage(stage.BaseGentooStage):
     def get_action_sequence(self):
         ret = []
         if self.seed:
-            ret.append( util.Step(self.unpack_seed,             always=False)   )
-        ret.append( util.Step(self.install_sources,             always=True)    )
+            ret.append( util.Step(self.unpack_seed,             always=False,
+                resource='io')                                                  )
+            ret.append( util.Step(self.mount_seed,              always=True,
+                resource='mount')                                               )
+        ret.append( util.Step(self.install_sources,             always=True,
+            resource='mount')                                                   )
         ret.append( util.Step(self.make_profile_link,           always=False)   )
-        ret.append( util.Step(self.merge_packages,              always=False)   )
-        ret.append( util.Step(self.target_merge_busybox,        always=False)   )
+        ret.append( util.Step(self.mount_pkg_store,             always=True,
+            resource='mount')                                                   )
+        ret.append( util.Step(self.merge_packages,              always=False,
+            conf_keys=('package_list', 'modules'), checkpoint=True,
+            resource='cpu')                                                     )
+        ret.append( util.Step(self.target_merge_busybox,        always=False,
+            resource='cpu')                                                     )
         if len(self.files) == 1:
-            ret.append( util.Step(self.target_merge_packages,   always=False)   )
+            ret.append( util.Step(self.target_merge_packages,   always=False,
+                conf_keys=('files',), resource='cpu')                           )
             ret.append( util.Step(self.copy_libs,               always=False)   )
         else:
-            ret.append( util.Step(self.copy_files,              always=False)   )
+            ret.append( util.Step(self.copy_files,              always=False,
+                conf_keys=('files',))                                           )
         ret.append( util.Step(self.install_modules,             always=False)   )
         ret.append( util.Step(self.update_init,                 always=False)   )
         if self.kernel:
-            ret.append( util.Step(self.merge_kernel,            always=False)   )
-        ret.append( util.Step(self.remove_sources,              always=False)   )
+            ret.append( util.Step(self.merge_kernel,            always=False,
+                resource='cpu')                                                 )
+        ret.append( util.Step(self.publish_packages,            always=True,
+            resource='io')                                                      )
+        ret.append( util.Step(self.remove_sources,              always=False,
+            resource='mount')                                                   )
         ret.append( util.Step(self.clean_root,                  always=True)    )
-        ret.append( util.Step(self.pack,                        always=False)   )
+        if self.pack_stage:
+            ret.append( util.Step(self.pack,                    always=False,
+                resource='io')                                                  )
+        ret.append( util.Step(self.umount_seed,                 always=True,
+            resource='mount')                                                   )
         ret.append( util.Step(self.finish_sources,              always=False)   )
         ret.append( util.Step(self.final_report,                always=True)    )
         return ret
@@ -179,7 +209,7 @@ class EmbeddedStage(stage.BaseGentooStage):
             self.env['INHIBITOR_SCRIPT_ROOT'], ' '.join(self.package_list))
 
         if self.seed:
-            util.chroot(
+            chroot.run(
                 path        = self.target_root,
                 function    = util.cmd,
                 fargs       = {'cmdline':cmdline, 'env':self.env},
@@ -205,18 +235,13 @@ class EmbeddedStage(stage.BaseGentooStage):
                 % self.env['INHIBITOR_SCRIPT_ROOT']
 
         if self.seed:
-            util.chroot(
+            chroot.run(
                 path        = self.target_root,
                 function    = util.cmd,
                 fargs       = {'cmdline':cmdline, 'env':env},
                 failuref    = self.chroot_failure
             )
-            util.chroot(
-                path        = self.target_root,
-                function    = self.path_sync_callback,
-                fargs       = {'src':'/bin/busybox', '_':None},
-                failuref    = self.chroot_failure
-            )
+            self._chroot_sync([(self.path_sync_callback, {'src':'/bin/busybox', '_':None})])
 
         else:
             util.cmd( cmdline, env = env )
@@ -231,7 +256,7 @@ class EmbeddedStage(stage.BaseGentooStage):
                 self.env['INHIBITOR_SCRIPT_ROOT'], ' '.join(self.package_list))
 
         if self.seed:
-            util.chroot(
+            chroot.run(
                 path        = self.target_root,
                 function    = util.cmd,
                 fargs       = {'cmdline':cmdline, 'env':env},
@@ -247,22 +272,45 @@ class EmbeddedStage(stage.BaseGentooStage):
 
         cmdline = 'ldd %s' % (binp,)
 
-        rc, output = util.cmd_out( cmdline, raise_exception=False)
-
-        if rc != 0:
-            return []
-        libs = []
-        for line in output.splitlines():
+        output = util.cmd_iter( cmdline, raise_exception=False)
+        found = []
+        for line in output:
             try:
-                lib = self.lddre.search(line).group(1)
+                found.append(self.lddre.search(line).group(1))
             except (IndexError, AttributeError):
                 continue
+
+        if output.returncode != 0:
+            return []
+        libs = []
+        for lib in found:
             if not lib in self.copied_libs:
                 self.copied_libs.append(lib)
                 libs.append( lib )
                 util.dbg("Adding required library %s" % lib)
         return libs
 
+    def _set_lib_state(self, copied_libs, checked_ldd):
+        self.copied_libs = copied_libs
+        self.checked_ldd = checked_ldd
+
+    def _lib_state(self):
+        return self.copied_libs, self.checked_ldd
+
+    def _chroot_sync(self, calls):
+        """
+        Run calls, which may use path_sync_callback, in the chroot worker for
+        target_root.  The libraries already copied and checked are sent along
+        and the helper's copy of them is returned afterwards, as the helper
+        cannot update this process.
+        """
+        if len(calls) == 0:
+            return
+        state = {'copied_libs': self.copied_libs, 'checked_ldd': self.checked_ldd}
+        calls = [(self._set_lib_state, state)] + calls + [(self._lib_state, {})]
+        results = chroot.batch(self.target_root, calls, failuref=self.chroot_failure)
+        self.copied_libs, self.checked_ldd = results[-1]
+
     def path_sync_callback(self, src, _):
         try:
             mime_type = self.ms.file(src).split(';')[0]
@@ -281,6 +329,7 @@ class EmbeddedStage(stage.BaseGentooStage):
             )
 
     def copy_files(self):
+        calls = []
         for min_path in self.files:
             if '*' in min_path:
                 if self.seed:
@@ -298,16 +347,11 @@ class EmbeddedStage(stage.BaseGentooStage):
                     if not os.path.lexists(self.target_root.pjoin(path)):
                         util.warn('Path (%s,%s) does not exist' % (min_path, path))
                         continue
-                    util.chroot(
-                        path        = self.target_root,
-                        function    = util.path_sync,
-                        fargs       = {
-                            'src':                  path,
-                            'targ':                 self.target_root.pjoin(path),
-                            'file_copy_callback':   self.path_sync_callback
-                        },
-                        failuref    = self.chroot_failure
-                    )
+                    calls.append((util.path_sync, {
+                        'src':                  path,
+                        'targ':                 self.target_root.pjoin(path),
+                        'file_copy_callback':   self.path_sync_callback
+                    }))
                 else:
                     if not os.path.lexists(path):
                         util.warn('Path %s does not exist' % (min_path,))
@@ -318,19 +362,21 @@ class EmbeddedStage(stage.BaseGentooStage):
                         file_copy_callback = self.path_sync_callback
                     )
 
+        # Everything is copied by a single chroot worker.
+        self._chroot_sync(calls)
+
     def copy_libs(self):
-        for root, _, files in os.walk(self.target_root):
-            for f in files:
-                src_path = os.path.join( root.replace(self.target_root, ''), f )
-                if self.seed:
-                    util.chroot(
-                        path        = self.target_root,
-                        function    = self.path_sync_callback,
-                        fargs       = {'src':src_path, '_':None},
-                        failuref    = self.chroot_failure
-                    )
-                else:
-                    self.path_sync_callback( src_path, None )
+        calls = []
+        for entry in util.walk(self.target_root):
+            if entry.is_dir():
+                continue
+            src_path = entry.path.replace(self.target_root, '')
+            if self.seed:
+                calls.append((self.path_sync_callback, {'src':src_path, '_':None}))
+            else:
+                self.path_sync_callback( src_path, None )
+
+        self._chroot_sync(calls)
 
     def install_modules(self):
         emb_root = self.target_root
@@ -355,18 +401,40 @@ class EmbeddedStage(stage.BaseGentooStage):
 
         util.mkdir(emb_root.pjoin('etc/rc.d'))
 
+        # Enable every service from a single shell in the chroot, marking the
+        # output of any that fail so they can all be reported.  The marker
+        # starts a new line in case the output of enable did not end in one.
+        marker = 'inhibitor-init-failed:'
+        script = ''
         for initd in glob.iglob('%s/*' % emb_root.pjoin('etc/init.d')):
             int_path = initd.replace(emb_root, '')
             util.dbg('Adding %s to init' % int_path)
-            util.chroot(
-                path        = emb_root,
-                function    = util.cmd,
-                fargs       = {
-                    'cmdline':  '%s enable' % int_path,
-                    'shell':    '/bin/ash'
-                },
-                failuref    = self.chroot_failure,
-            )
+            script += "if ! '%s' enable; then echo; echo '%s%s'; fi\n" % (int_path, marker, int_path)
+
+        if not script:
+            return
+
+        _, output = chroot.run(
+            path        = emb_root,
+            function    = util.cmd_out,
+            fargs       = {
+                'cmdline':  script,
+                'shell':    '/bin/ash'
+            },
+            failuref    = self.chroot_failure,
+        )
+
+        failed = []
+        for line in output.splitlines():
+            if line.startswith(marker):
+                failed.append(line[len(marker):])
+            elif line:
+                print line
+        for int_path in failed:
+            util.err("'%s enable' failed" % (int_path,))
+        if failed:
+            self.chroot_failure()
+            raise util.InhibitorError("Failed to enable %s" % (' '.join(failed),))
 
     def merge_kernel(self):
         args = ['--build_name', self.build_name,
@@ -382,7 +450,7 @@ class EmbeddedStage(stage.BaseGentooStage):
 
         if self.seed:
             util.mkdir( self.target_root.pjoin(env['ROOT']) )
-            util.chroot(
+            chroot.run(
                 path        = self.target_root,
                 function    = util.cmd,
                 fargs       = {'cmdline':cmdline, 'env':env},
@@ -391,7 +459,7 @@ class EmbeddedStage(stage.BaseGentooStage):
 
             # Grab any modules or firmware and put them into the embedded root fs.
             for d in ('modules', 'firmware'):
-                util.chroot(
+                chroot.run(
                     path        = self.target_root,
                     function    = util.cmd,
                     fargs       = {'cmdline': 'rsync -a --delete-after %s %s/' % (
@@ -439,17 +507,16 @@ class EmbeddedStage(stage.BaseGentooStage):
         basedir = util.Path( os.path.dirname(self.tarpath) )
         util.mkdir(basedir)
 
-        archive = tarfile.open(self.tarpath, 'w:bz2')
-        archive.add(emb_root,
-            arcname = '/',
-            recursive = True
-        )
-        archive.close()
-
-        curdir = os.path.realpath(os.curdir)
-        os.chdir(emb_root)
-        util.cmd('find ./ | cpio -H newc -o | gzip -c -9 > %s' % (self.cpiopath))
-        os.chdir(curdir)
+        # Both images are written in one walk of the tree, each through its own
+        # compressor.
+        writers = [archive.ArchiveWriter(self.tarpath, self.compression)]
+        try:
+            writers.append(archive.ArchiveWriter(
+                self.cpiopath, self.initramfs_compression, format='cpio'))
+        except:
+            writers[0].abort()
+            raise
+        archive.write_tree(emb_root, writers)
 
         if self.kernel:
             r = util.Path('/')
@@ -472,6 +539,9 @@ class EmbeddedStage(stage.BaseGentooStage):
             src.finish()
 
     def final_report(self):
+        self.report_packages()
+        if not self.pack_stage:
+            return
         util.info("Created %s" % (self.tarpath,))
         util.info("Created %s" % (self.cpiopath,))
         if self.conf.has('kernel'):
@@ -1,9 +1,24 @@
 import os
+import sys
+import errno
+import fcntl
+import select
 
+import chroot
+import locks
+import namespace
 import util
 
 __version__ = '0.1'
 
+# Number of steps using each resource, see util.Step, that may run at once
+# across all of the actions running concurrently.
+RESOURCE_LIMITS = {
+    'cpu':      1,
+    'io':       2,
+    'mount':    1,
+}
+
 class InhibitorState(object):
     """
     Track the state of the current inhibitor build as well as holding
@@ -41,6 +56,19 @@ class InhibitorState(object):
         self.mount_points   = []
         self.children       = []
         self.current_action = None
+        self.permits        = None
+
+    def acquire(self, resource):
+        """
+        Wait for a free slot of resource when running in a worker, see
+        Inhibitor.  Steps of an action run alone do not wait.
+        """
+        if self.permits != None and resource != None:
+            self.permits.acquire(resource)
+
+    def release(self, resource):
+        if self.permits != None and resource != None:
+            self.permits.release(resource)
 
     def makedirs(self):
         """Create all the directories that may be needed during runtime."""
@@ -50,6 +78,59 @@ class InhibitorState(object):
                 os.makedirs(path)
 
 
+def _set_cloexec(fd):
+    fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+
+class _Permits(object):
+    """
+    Asks the scheduler in the parent process for resource slots from a worker.
+    The scheduler keeps count of the slots each worker holds and takes them
+    back when the worker exits, however it exits.
+
+    @param requests - Pipe to write requests to.
+    @param grants   - Pipe the scheduler writes a byte to for each slot granted.
+    """
+    def __init__(self, requests, grants):
+        self.requests   = requests
+        self.grants     = grants
+
+    def acquire(self, resource):
+        os.write(self.requests, 'acquire %s\n' % (resource,))
+        while True:
+            try:
+                granted = os.read(self.grants, 1)
+                break
+            except OSError, e:
+                if e.errno != errno.EINTR:
+                    raise
+        if granted == '':
+            raise util.InhibitorError("Lost the scheduler waiting for %s" % (resource,))
+
+    def release(self, resource):
+        os.write(self.requests, 'release %s\n' % (resource,))
+
+class _Worker(object):
+    """A forked worker running action, as seen by the scheduler."""
+    def __init__(self, pid, action, requests, grants):
+        self.pid        = pid
+        self.action     = action
+        self.requests   = requests
+        self.grants     = grants
+        self.buffer     = ''
+        self.held       = []
+
+    def grant(self):
+        try:
+            os.write(self.grants, '\n')
+        except OSError, e:
+            # The worker died waiting, its slots are taken back as it is reaped.
+            if e.errno != errno.EPIPE:
+                raise
+
+    def close(self):
+        os.close(self.requests)
+        os.close(self.grants)
+
 class Inhibitor(object):
     """
     Holding class for Actions.  Serves to run and track the state
@@ -64,27 +145,238 @@ class Inhibitor(object):
         kernel      - Temporary staging directory for building kernels.
         state       - Tracks the state of each build in order to support resuming.
         share       - Path to shared support files.
+    @param namespace - Run each action in its own mount and pid namespace so
+                       that its mounts and processes are dropped by the kernel
+                       when it finishes (False).  Changes an action makes to its
+                       own state are then not visible after run_action.
+    @param jobs     - Number of actions to run at once (1).  With more than one,
+                      each action runs in a forked worker process and a failed
+                      action only stops the actions depending on it.  Workers
+                      get slots of limited resources from this process, which
+                      takes back the slots of a worker and unmounts what it
+                      left behind when it dies.
+    @param limits   - Dictionary of resource name to the number of steps using
+                      it that may run at once, overriding RESOURCE_LIMITS.
     """
-    def __init__(self, paths={}):
+    def __init__(self, paths={}, namespace=False, jobs=1, limits={}):
         self.actions    = []
+        self.depends    = {}
+        self.namespace  = namespace
+        self.jobs       = jobs
+        self.limits     = dict(RESOURCE_LIMITS)
+        self.limits.update(limits)
         self.state      = InhibitorState(paths=paths)
         self.state.makedirs()
 
-    def add_action(self, action):
-        """Add the given action the the run queue."""
+    def add_action(self, action, depends=()):
+        """
+        Add the given action the the run queue.  The action runs after the
+        queued actions in depends and those named by action.dependencies().
+        Actions with the same name share their build directories and run in
+        the order they were added.
+        """
         self.actions.insert(0, action)
+        self.depends[action] = list(depends)
+
+    def _graph(self):
+        """
+        Return the queued actions in the order they were added and a dictionary
+        of each action to the set of queued actions it waits for.
+        """
+        queued = list(reversed(self.actions))
+        waits = {}
+        for i, action in enumerate(queued):
+            deps = set(self.depends.get(action, [])) | set(action.dependencies())
+            deps.update([a for a in queued[:i] if a.name == action.name])
+            waits[action] = set([a for a in deps if a in queued and a is not action])
+        return queued, waits
+
+    def _next(self, queued, waits, done):
+        for action in queued:
+            if waits[action].issubset(done):
+                return action
+        return None
 
     def run(self):
-        """Run all of the actions on the queue."""
-        while len(self.actions) > 0:
-            self.run_action(self.actions.pop())
+        """
+        Run all of the actions on the queue, each after the actions it depends
+        on.  Independent actions run concurrently when jobs is more than one.
+        """
+        queued, waits = self._graph()
+        if self.jobs > 1:
+            return self._run_workers(queued, waits)
+
+        done = set()
+        while len(queued) > 0:
+            action = self._next(queued, waits, done)
+            if action == None:
+                raise util.InhibitorError("Circular dependency between %s"
+                    % (', '.join([a.name for a in queued]),))
+            queued.remove(action)
+            self.actions.remove(action)
+            self.run_action(action)
+            done.add(action)
+
+    def _start_worker(self, action):
+        """Run action in a forked worker, returning its _Worker."""
+        req_r, req_w = os.pipe()
+        grant_r, grant_w = os.pipe()
+        # Programs run by the worker must not keep its pipes open.
+        for fd in (req_r, req_w, grant_r, grant_w):
+            _set_cloexec(fd)
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                os.close(req_r)
+                os.close(grant_w)
+                for worker in self.running.values():
+                    worker.close()
+                self.state.permits = _Permits(req_w, grant_r)
+                code = namespace.isolated_main(self.run_action, (action,))
+            finally:
+                os._exit(code)
+        os.close(req_w)
+        os.close(grant_r)
+        util.info("Started %s in worker %d" % (action.name, pid))
+        return _Worker(pid, action, req_r, grant_w)
+
+    def _request(self, worker, line):
+        verb, resource = line.split()
+        if not resource in self.limits:
+            if verb == 'acquire':
+                worker.grant()
+        elif verb == 'acquire':
+            self.waiting.append((worker, resource))
+        elif resource in worker.held:
+            worker.held.remove(resource)
+            self.free[resource] += 1
+        self._dispatch()
+
+    def _dispatch(self):
+        """Grant free slots to the workers waiting for them, in order."""
+        for worker, resource in list(self.waiting):
+            if self.free[resource] > 0:
+                self.free[resource] -= 1
+                self.waiting.remove((worker, resource))
+                worker.held.append(resource)
+                worker.grant()
+
+    def _release(self, worker, code):
+        """Take back everything worker, which exited with code, held."""
+        worker.close()
+        for resource in worker.held:
+            self.free[resource] += 1
+        worker.held = []
+        self.waiting = [(w, r) for w, r in self.waiting if w is not worker]
+        self._dispatch()
+        if code != 0 and not self.namespace:
+            # A killed worker cannot unmount what it mounted.
+            for path in worker.action.mount_roots(self.state):
+                util.umount_under(path)
+
+    def _wait_workers(self):
+        """
+        Serve resource requests until a worker exits, returning the _Worker
+        and its exit status.
+        """
+        while True:
+            try:
+                ready, _, _ = select.select(
+                    [w.requests for w in self.running.values()], [], [])
+            except select.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            for fd in ready:
+                worker = [w for w in self.running.values() if w.requests == fd][0]
+                data = os.read(fd, 4096)
+                if data == '':
+                    # The worker closes its pipes by exiting.
+                    del self.running[worker.pid]
+                    code = namespace.wait(worker.pid)
+                    self._release(worker, code)
+                    return worker, code
+                worker.buffer += data
+                while '\n' in worker.buffer:
+                    line, worker.buffer = worker.buffer.split('\n', 1)
+                    self._request(worker, line)
+
+    def _stop_workers(self):
+        """Kill the running workers and clean up after them."""
+        util._kill_pids(self.running.keys())
+        for worker in self.running.values():
+            self._release(worker, -1)
+        self.running = {}
+
+    def _run_workers(self, queued, waits):
+        self.running    = {}
+        self.free       = dict(self.limits)
+        self.waiting    = []
+        done    = set()
+        failed  = []
+        try:
+            while len(queued) > 0 or len(self.running) > 0:
+                # Nothing that depends on a failed action can run.
+                skipped = True
+                while skipped:
+                    skipped = False
+                    for action in list(queued):
+                        if waits[action] & set(failed):
+                            util.err("Not running %s, %s failed" % (action.name,
+                                ', '.join([a.name for a in waits[action] & set(failed)])))
+                            queued.remove(action)
+                            self.actions.remove(action)
+                            failed.append(action)
+                            skipped = True
+
+                while len(self.running) < self.jobs:
+                    action = self._next(queued, waits, done)
+                    if action == None:
+                        break
+                    queued.remove(action)
+                    self.actions.remove(action)
+                    worker = self._start_worker(action)
+                    self.running[worker.pid] = worker
+
+                if len(self.running) == 0:
+                    if len(queued) > 0:
+                        raise util.InhibitorError("Circular dependency between %s"
+                            % (', '.join([a.name for a in queued]),))
+                    break
+
+                worker, code = self._wait_workers()
+                action = worker.action
+                if code == 0:
+                    util.info("Finished %s" % (action.name,))
+                    done.add(action)
+                else:
+                    util.err("%s failed with %d" % (action.name, code))
+                    failed.append(action)
+        except (KeyboardInterrupt, SystemExit, Exception):
+            self._stop_workers()
+            raise
+
+        if len(failed) > 0:
+            raise util.InhibitorError("Failed actions: %s"
+                % (', '.join([a.name for a in failed]),))
 
     def run_action(self, action):
+        if self.namespace:
+            namespace.run_isolated(self._run_action, action)
+        else:
+            self._run_action(action)
+
+    def _run_action(self, action):
         try:
             action.post_conf(self.state)
             action.run()
         except Exception:
+            chroot.stop_workers()
             util.umount_all(self.state.mount_points)
             raise
-
-
+        finally:
+            chroot.stop_workers()
+            locks.release_all()
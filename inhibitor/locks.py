@@ -0,0 +1,101 @@
+import os
+import errno
+import fcntl
+import shutil
+
+import util
+
+# Locks taken by this process that have not been released.
+_held = []
+
+class Lock(object):
+    """
+    Reader/writer lock shared between processes, using flock(2) on a lock
+    file.  Any number of processes may hold the lock shared or a single one
+    may hold it exclusively.  The kernel drops the lock if the holder exits
+    without releasing it, so a crashed build never leaves a stale lock.
+
+    Each Lock opens the file separately, two Locks on the same path in one
+    process exclude each other like locks held by different processes.
+
+    @param path     - Path of the lock file, created if needed.
+    """
+    def __init__(self, path):
+        self.path   = util.Path(path)
+        self.fd     = None
+        self.shared = None
+
+    def acquire(self, shared=False, blocking=True):
+        """
+        Take the lock, shared or exclusive, converting it if this Lock already
+        holds it.  Returns False if blocking is False and the lock is held by
+        another process, otherwise True.
+
+        Converting is not atomic, flock(2) drops the old lock before taking
+        the new one, so another process may take the lock in between.  Anything
+        checked under the old lock must be checked again after converting.
+        """
+        if self.fd == None:
+            util.mkdir(os.path.dirname(self.path))
+            self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0644)
+            # Processes run by the build must not keep the lock past its end.
+            fcntl.fcntl(self.fd, fcntl.F_SETFD,
+                fcntl.fcntl(self.fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+            _held.append(self)
+
+        if shared:
+            mode = fcntl.LOCK_SH
+        else:
+            mode = fcntl.LOCK_EX
+        try:
+            fcntl.flock(self.fd, mode | fcntl.LOCK_NB)
+        except IOError, e:
+            if e.errno != errno.EWOULDBLOCK:
+                raise
+            if not blocking:
+                if self.shared == None:
+                    self.release()
+                return False
+            util.info("Waiting for %s" % (self.path,))
+            fcntl.flock(self.fd, mode)
+        self.shared = shared
+        return True
+
+    def release(self):
+        if self.fd == None:
+            return
+        os.close(self.fd)
+        self.fd = None
+        self.shared = None
+        if self in _held:
+            _held.remove(self)
+
+def release_all():
+    """Release every lock this process holds."""
+    for lock in list(_held):
+        lock.release()
+
+def temp_path(path):
+    """
+    Return a path next to path, unique to this process, to write the contents
+    of path to before moving them into place with publish().
+    """
+    return util.Path('%s.%d.tmp' % (path, os.getpid()))
+
+def publish(tmp, path):
+    """
+    Move tmp into place at path so that other processes see either the old
+    path or the complete new one.  Files replace path.  A directory is only
+    moved into place if path is missing or empty, otherwise another process
+    published it first and tmp is removed.
+    """
+    if os.path.isdir(tmp) and not os.path.islink(tmp):
+        try:
+            os.rename(tmp, path)
+        except OSError, e:
+            if not e.errno in (errno.EEXIST, errno.ENOTEMPTY):
+                raise
+            util.dbg("%s was published by another process" % (path,))
+            shutil.rmtree(tmp)
+    else:
+        os.rename(tmp, path)
@@ -0,0 +1,100 @@
+import os
+import sys
+import errno
+import signal
+import traceback
+
+import util
+
+CLONE_NEWNS     = 0x00020000
+CLONE_NEWPID    = 0x20000000
+
+def unshare_mounts():
+    """
+    Move this process into a private mount namespace.  Mounts made afterwards
+    are invisible to the host and are released by the kernel when the last
+    process in the namespace exits.
+    """
+    util.unshare(CLONE_NEWNS)
+    util.cmd('mount --make-rprivate /')
+    util.MOUNT_NAMESPACE = True
+
+def wait(pid):
+    """Wait for the child pid to exit and return its exit code."""
+    while True:
+        try:
+            _, status = os.waitpid(pid, 0)
+        except OSError, e:
+            if e.errno == errno.EINTR:
+                continue
+            raise
+        if os.WIFEXITED(status):
+            return os.WEXITSTATUS(status)
+        return 128 + os.WTERMSIG(status)
+
+def isolated_main(function, args):
+    """
+    Run function with args, reporting any error, and return the exit code
+    for the process running it.
+    """
+    code = 1
+    try:
+        try:
+            function(*args)
+            code = 0
+        except util.InhibitorError, e:
+            util.err(' '.join([str(a) for a in e.args]))
+        except (KeyboardInterrupt, SystemExit, Exception):
+            util.err(traceback.format_exc())
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+    return code
+
+def run_isolated(function, *args):
+    """
+    Run function in a new mount and pid namespace.  Every mount it makes and
+    every process it starts is torn down by the kernel once it returns, even if
+    it fails or is killed, so no scan of the host's processes is needed to
+    clean up after it.
+
+    The function runs in a forked child.  Changes it makes to objects in this
+    process are not seen here, only success or failure is reported.  If this
+    process is killed, the kernel kills the child and the namespace with it.
+
+    @param function     - Function to run.
+    @param args         - Arguments to pass to function.
+    """
+    sys.stdout.flush()
+    sys.stderr.flush()
+
+    parent = os.getpid()
+    pid = os.fork()
+    if pid == 0:
+        code = 1
+        try:
+            try:
+                util.set_pdeathsig(signal.SIGKILL)
+                if os.getppid() != parent:
+                    # Killed before the death signal was set up.
+                    os._exit(code)
+                unshare_mounts()
+                # The first child after unsharing the pid namespace becomes its
+                # init, when it exits every other process in it is killed.  An
+                # init only gets signals it handles, apart from SIGKILL sent
+                # from outside of the namespace, as the death signal is.
+                util.unshare(CLONE_NEWPID)
+                child = os.fork()
+                if child == 0:
+                    util.set_pdeathsig(signal.SIGKILL)
+                    os._exit(isolated_main(function, args))
+                code = wait(child)
+            except (KeyboardInterrupt, SystemExit, Exception):
+                util.err(traceback.format_exc())
+        finally:
+            os._exit(code)
+
+    code = wait(pid)
+    if code != 0:
+        raise util.InhibitorError("Isolated run of %s failed with %d" % (
+            getattr(function, '__name__', function), code))
@@ -0,0 +1,234 @@
+import os
+import re
+import time
+import shutil
+import cPickle
+
+import locks
+import util
+
+# Portage settings a binary package depends on beyond its own USE flags, which
+# portage checks itself.  Builds agreeing on all of them can share packages.
+COMPAT_VARS = ('CHOST', 'CFLAGS', 'CXXFLAGS', 'LDFLAGS', 'USE')
+
+# Files portage writes into PKGDIR that are packages.
+PACKAGE_SUFFIXES = ('.tbz2', '.xpak', '.gpkg.tar')
+
+_merge_re = re.compile(r'=== \(\d+ of \d+\) (Merging Binary|Compiling/Merging) \(')
+_start_re = re.compile(r'^(\d+):\s+>>> emerge \(\d+ of \d+\) (\S+) to ')
+_done_re  = re.compile(r'^(\d+):\s+::: completed emerge \(\d+ of \d+\) (\S+) to ')
+
+class PackageStore(object):
+    """
+    Binary packages shared by every build on the host.  The store is split
+    into partitions by the settings in COMPAT_VARS and the profile, each being
+    a package directory for portage.  A build sees its partition read only
+    through an overlay, with the packages it builds kept in its own directory,
+    and publishes those into the partition once its merges are done.
+
+    The index in the store records the settings of each partition.  Each
+    partition has portage's Packages index of the packages in it, kept up to
+    date by publish() so that portage does not have to read every package.
+
+    @param path     - Directory of the store.
+    """
+    def __init__(self, path):
+        self.path   = util.Path(path)
+        self.lock   = locks.Lock(self.path.pjoin('lock'))
+
+    def index(self):
+        """Return a dictionary of partition name to the settings it holds packages for."""
+        path = self.path.pjoin('index')
+        if not os.path.exists(path):
+            return {}
+        f = open(path, 'rb')
+        try:
+            return cPickle.load(f)
+        finally:
+            f.close()
+
+    def partition(self, settings):
+        """
+        Return the package directory for builds with settings, a dictionary of
+        the values of COMPAT_VARS and the profile, creating it if needed.
+        """
+        key = util.fingerprint(sorted(settings.items()))
+        path = self.path.pjoin(key)
+        if os.path.isdir(path):
+            return path
+
+        self.lock.acquire()
+        try:
+            util.mkdir(path)
+            index = self.index()
+            index[key] = dict(settings)
+            tmp = locks.temp_path(self.path.pjoin('index'))
+            f = open(tmp, 'wb')
+            cPickle.dump(index, f, 2)
+            f.close()
+            locks.publish(tmp, self.path.pjoin('index'))
+        finally:
+            self.lock.release()
+        util.info("Created binary package partition %s" % (path,))
+        return path
+
+    def publish(self, partition, pkgdir):
+        """
+        Add the packages in pkgdir that partition does not have yet to it.
+        Each package is copied next to its place in the partition and renamed
+        into it, so builds reading the partition never see a partial package.
+        Returns the number of packages added.
+        """
+        added = 0
+        prefix = len(pkgdir.rstrip('/')) + 1
+        for entry in util.walk(pkgdir):
+            if not entry.name.endswith(PACKAGE_SUFFIXES):
+                continue
+            if not entry.is_file(follow_symlinks=False):
+                continue
+            rel = entry.path[prefix:]
+            dest = util.Path(partition).pjoin(rel)
+            if os.path.exists(dest):
+                continue
+            util.mkdir(os.path.dirname(dest))
+            tmp = locks.temp_path(dest)
+            shutil.copy2(entry.path, tmp)
+            locks.publish(tmp, dest)
+            util.dbg("Published %s" % (rel,))
+            added += 1
+
+        if os.path.exists(util.Path(pkgdir).pjoin('Packages')):
+            self.lock.acquire()
+            try:
+                self._update_packages(partition, pkgdir)
+            finally:
+                self.lock.release()
+        return added
+
+    def _update_packages(self, partition, pkgdir):
+        """
+        Add the entries of the Packages index portage wrote in pkgdir for the
+        packages now in partition to the partition's index.  Runs under the
+        store lock, as other builds publish to the same index.
+        """
+        path = util.Path(partition).pjoin('Packages')
+        header, entries = read_packages(path)
+        new_header, new_entries = read_packages(util.Path(pkgdir).pjoin('Packages'))
+        if len(header) == 0:
+            header = new_header
+
+        index = {}
+        # Packages already in the partition were not replaced, keep their entries.
+        for entry in new_entries + entries:
+            rel = _package_path(entry)
+            if os.path.exists(util.Path(partition).pjoin(rel)):
+                index[rel] = entry
+        entries = sorted(index.values(), key=lambda e: (dict(e)['CPV'], _package_path(e)))
+
+        header = [(k, v) for k, v in header if not k in ('PACKAGES', 'TIMESTAMP')]
+        header.extend([('PACKAGES', str(len(entries))), ('TIMESTAMP', str(int(time.time())))])
+        header.sort()
+
+        tmp = locks.temp_path(path)
+        f = open(tmp, 'w')
+        try:
+            for block in [header] + entries:
+                # Portage leaves out empty values as well.
+                for k, v in block:
+                    if v != '':
+                        f.write('%s: %s\n' % (k, v))
+                f.write('\n')
+        finally:
+            f.close()
+        locks.publish(tmp, path)
+
+def read_packages(path):
+    """
+    Read portage's Packages index at path.  Returns the header and a list of
+    the package entries, each a list of (key, value) pairs in file order.
+    Both are empty if there is no index.
+    """
+    blocks = []
+    if not os.path.exists(path):
+        return [], []
+    block = []
+    f = open(path)
+    try:
+        for line in f:
+            line = line.rstrip('\n')
+            if line == '':
+                if len(block) > 0:
+                    blocks.append(block)
+                block = []
+                continue
+            k, _, v = line.partition(':')
+            block.append((k, v.lstrip(' ')))
+    finally:
+        f.close()
+    if len(block) > 0:
+        blocks.append(block)
+    if len(blocks) == 0:
+        return [], []
+    return blocks[0], blocks[1:]
+
+def _package_path(entry):
+    """Return the path of the package of a Packages entry, relative to PKGDIR."""
+    entry = dict(entry)
+    return entry.get('PATH', entry['CPV'] + '.tbz2')
+
+def log_offset(log):
+    """Return the current size of the emerge log log, for merge_counts()."""
+    if not os.path.exists(log):
+        return 0
+    return os.path.getsize(log)
+
+def merge_counts(log, offset=0):
+    """
+    Return the number of packages merged from binary packages and the number
+    built from source according to the emerge log log, after offset.
+    """
+    binary = 0
+    source = 0
+    if not os.path.exists(log):
+        return binary, source
+    f = open(log)
+    try:
+        f.seek(offset)
+        for line in f:
+            m = _merge_re.search(line)
+            if m == None:
+                continue
+            if m.group(1) == 'Merging Binary':
+                binary += 1
+            else:
+                source += 1
+    finally:
+        f.close()
+    return binary, source
+
+def merge_times(log, offset=0):
+    """
+    Return a list of (cpv, start, seconds) for each package merged according
+    to the emerge log log after offset, in the order their merges started.
+    Merges running in parallel are told apart by their cpv.
+    """
+    started = {}
+    times = []
+    if not os.path.exists(log):
+        return times
+    f = open(log)
+    try:
+        f.seek(offset)
+        for line in f:
+            m = _start_re.match(line)
+            if m != None:
+                started[m.group(2)] = int(m.group(1))
+                continue
+            m = _done_re.match(line)
+            if m != None and m.group(2) in started:
+                start = started.pop(m.group(2))
+                times.append((m.group(2), start, int(m.group(1)) - start))
+    finally:
+        f.close()
+    times.sort(key=lambda t: t[1])
+    return times
@@ -0,0 +1,167 @@
+import os
+import shutil
+
+import archive
+import locks
+import util
+
+# Number of unpacked versions kept for each seed.
+SEED_CACHE_KEEP = 3
+
+class SeedCache(object):
+    """
+    Unpacked seed stages, keyed by the content hash of the seed archive.  The
+    seed is used through path, a symlink to the unpacked copy of the current
+    archive, so replacing the archive is noticed and only costs one unpack.
+    Older copies are kept in case the archive is switched back and evicted in
+    least recently used order.
+
+    Archives are unpacked with the parallel decompressors from
+    archive.COMPRESSION next to the cache entry and renamed into place once
+    complete, and path is swapped to the new entry with a rename as well.
+
+    The cache is shared by every inhibitor process on the host.  Updates hold
+    an exclusive lock on the cache, and a process using an entry holds a shared
+    lock on it until the end of its action so that it is never evicted while
+    in use.  Entry locks are only taken under the cache lock, and their files
+    are never removed, so that every process locks the same file.
+
+    @param path - Path of the seed without an archive extension, the archive
+                  is looked for next to it.
+    @param keep - Number of unpacked versions to keep (SEED_CACHE_KEEP).
+    """
+    def __init__(self, path, keep=SEED_CACHE_KEEP):
+        self.path       = util.Path(path)
+        self.cachedir   = util.Path(os.path.dirname(self.path)).pjoin(
+                            '.seeds', os.path.basename(self.path))
+        self.keep       = keep
+        self.lock       = locks.Lock(self.cachedir.pjoin('lock'))
+
+    def digest(self, seedfile):
+        """
+        Return the sha1 of seedfile.  The result is remembered along with the
+        size, mtime and inode of the file so that it is only computed again
+        when the archive is replaced.
+        """
+        st = os.stat(seedfile)
+        key = '%s %d %r %d' % (os.path.basename(seedfile), st.st_size, st.st_mtime, st.st_ino)
+        stamp = self.cachedir.pjoin('digest')
+        if os.path.exists(stamp):
+            f = open(stamp)
+            try:
+                saved_key, _, saved_digest = f.read().strip().rpartition(' ')
+            finally:
+                f.close()
+            if saved_key == key:
+                return saved_digest
+
+        util.info("Hashing %s" % (seedfile,))
+        digest = util.file_digest(seedfile)
+
+        util.mkdir(self.cachedir)
+        tmp = locks.temp_path(stamp)
+        f = open(tmp, 'w')
+        f.write('%s %s\n' % (key, digest))
+        f.close()
+        locks.publish(tmp, stamp)
+        return digest
+
+    def update(self):
+        """
+        Point path at the unpacked contents of the current seed archive,
+        unpacking it first if it is not cached, and hold the entry until the
+        end of the action.  Returns the unpacked directory.
+        """
+        seedfile = archive.find_tarball(self.path)
+        if seedfile == None:
+            if os.path.isdir(self.path):
+                util.warn("No archive found for %s, using it as is." % (self.path,))
+                return self.path
+            raise util.InhibitorError("No seed archive found for %s" % (self.path,))
+
+        self.lock.acquire()
+        try:
+            target = self.cachedir.pjoin(self.digest(seedfile))
+            if not os.path.isdir(target):
+                util.info("Unpacking %s" % seedfile)
+                tmp = locks.temp_path(target)
+                if os.path.exists(tmp):
+                    shutil.rmtree(tmp)
+                os.makedirs(tmp)
+                try:
+                    util.cmd(archive.extract_cmd(seedfile, tmp))
+                except:
+                    shutil.rmtree(tmp)
+                    raise
+                locks.publish(tmp, target)
+
+            # The mtime of each entry records when it was last used.
+            os.utime(target, None)
+            self._hold(target)
+            self._link(target)
+            self._evict(target)
+        finally:
+            self.lock.release()
+        return target
+
+    def hold(self, target=None):
+        """
+        Take a shared lock on the unpacked entry target, by default the one
+        path points to, so that other processes do not evict it.  The lock is
+        kept until locks.release_all() at the end of the action.
+        """
+        self.lock.acquire(shared=True)
+        try:
+            if target == None:
+                if not os.path.islink(self.path):
+                    return
+                target = os.path.join(os.path.dirname(self.path), os.readlink(self.path))
+            self._hold(target)
+        finally:
+            self.lock.release()
+
+    def _hold(self, target):
+        if not os.path.isdir(target):
+            raise util.InhibitorError("Seed %s has been removed from the cache" % (target,))
+        locks.Lock(target + '.lock').acquire(shared=True)
+
+    def _link(self, target):
+        link = os.path.relpath(target, os.path.dirname(self.path))
+        if os.path.islink(self.path):
+            if os.readlink(self.path) == link:
+                return
+        elif os.path.isdir(self.path):
+            # Unpacked by an older inhibitor, without a hash to check it by.
+            shutil.rmtree(self.path)
+        elif os.path.exists(self.path):
+            os.unlink(self.path)
+
+        tmp = locks.temp_path(self.path)
+        if os.path.lexists(tmp):
+            os.unlink(tmp)
+        os.symlink(link, tmp)
+        locks.publish(tmp, self.path)
+
+    def _evict(self, current):
+        entries = []
+        for name in os.listdir(self.cachedir):
+            path = self.cachedir.pjoin(name)
+            if name in ('digest', 'lock') or name.endswith('.lock') or path == current:
+                continue
+            if name.endswith('.tmp'):
+                # Left behind by a process that failed while unpacking.
+                if os.path.isdir(path):
+                    util.dbg("Removing %s" % (path,))
+                    shutil.rmtree(path)
+            elif os.path.isdir(path):
+                entries.append((os.stat(path).st_mtime, path))
+
+        entries.sort(reverse=True)
+        for _, path in entries[max(self.keep - 1, 0):]:
+            lock = locks.Lock(path + '.lock')
+            if not lock.acquire(blocking=False):
+                util.dbg("Not removing seed %s, it is in use" % (path,))
+                continue
+            util.info("Removing unused seed %s" % (path,))
+            shutil.rmtree(path)
+            lock.release()
@@ -1,7 +1,9 @@
 import shutil
 import os
 import types
+import hashlib
 
+import locks
 import util
 
 def create_source(src, **keywds):
@@ -37,6 +39,16 @@ class _GenericSource(object):
     @param ignore               - Files to be ignored when installing.  Either a function
                                   returning true or false for a given path or a list of
                                   patterns to be ignored.  See shutil.ignore_patterns.
+    @param incremental          - Keep a manifest of installed files and skip copying
+                                  those that have not changed on later installs.
+    @param checksum             - Compare file contents as well when installing
+                                  incrementally.  See util.Manifest.
+    @param copy_backend         - How files are copied when installing, see
+                                  util.FileCopier.  'hardlink' is only safe for
+                                  sources that are never modified in the stage.
+    @param cache                - The source holds a cache or the output of the
+                                  build, such as distfiles or binary packages, so
+                                  its contents are left out of identity().
     """
     def __init__(self, src,
             inhibitor_state = None,
@@ -45,6 +57,10 @@ class _GenericSource(object):
             mountable       = False,
             cachedir        = None,
             ignore          = None,
+            incremental     = False,
+            checksum        = False,
+            copy_backend    = 'auto',
+            cache           = False,
             **keywds                ):
         self.src        = src
         self.istate     = inhibitor_state
@@ -54,6 +70,10 @@ class _GenericSource(object):
         self.cachedir   = cachedir
         self.mount      = None
         self.installed  = []
+        self.incremental = incremental
+        self.checksum   = checksum
+        self.copy_backend = copy_backend
+        self.cache      = cache
 
         if ignore:
             self.ignore = ignore
@@ -68,6 +88,13 @@ class _GenericSource(object):
     def init(self):
         raise util.InhibitorError("init() is undefined for %s" % (self.src,))
 
+    def identity(self):
+        """
+        Return what identifies the content this source installs, for
+        util.fingerprint().  Only valid after init().
+        """
+        return [self.__class__.__name__, self.src, self.dest, self.keep]
+
     def file_copy_callback(self, _, targ):
         self.installed.append(targ)
 
@@ -97,12 +124,19 @@ class _GenericSource(object):
             self.mount = util.Mount(src, self.dest, root)
             util.mount(self.mount, self.istate.mount_points)
         else:
+            manifest = None
+            if self.incremental:
+                manifest = self.istate.paths.state.pjoin('manifests',
+                    hashlib.sha1('%s\0%s' % (src, full_dest)).hexdigest())
             util.path_sync(
                 src,
                 full_dest,
                 root = root,
                 ignore = self.ignore,
-                file_copy_callback = self.file_copy_callback
+                file_copy_callback = self.file_copy_callback,
+                manifest = manifest,
+                checksum = self.checksum,
+                backend = self.copy_backend
             )
         return
 
@@ -121,6 +155,10 @@ class FileSource(_GenericSource):
     @param ignore               - Files to be ignored when installing.  Either a function
                                   returning true or false for a given path or a list of
                                   patterns to be ignored.  See shutil.ignore_patterns.
+    @param incremental          - Skip copying unchanged files on later installs.
+    @param checksum             - Compare file contents when installing incrementally.
+    @param copy_backend         - How files are copied when installing.
+    @param cache                - Leave the contents out of identity().
     """
     def __init__(self, src, inhibitor_state = None, dest = None, keep = False, mountable=None, **keywds):
         real_src    = util.Path(src[6:])
@@ -145,6 +183,12 @@ class FileSource(_GenericSource):
         # will be left in the chroot and is a directory or not.
         return
 
+    def identity(self):
+        if self.cache:
+            return super(FileSource, self).identity()
+        return super(FileSource, self).identity() + [
+            util.tree_identity(self.src, ignore=self.ignore, checksum=self.checksum)]
+
 
 class FuncSource(_GenericSource):
     """
@@ -183,6 +227,9 @@ class FuncSource(_GenericSource):
         # time anyways.
         return
 
+    def identity(self):
+        return super(FuncSource, self).identity() + [self.output]
+
     def _write_dictionary(self, destdir, d):
         for k, v in d.items():
             if type(v) == types.StringType:
@@ -238,11 +285,21 @@ class GitSource(_GenericSource):
     @param ignore               - Files to be ignored when installing.  Either a function
                                   returning true or false for a given path or a list of
                                   patterns to be ignored.  See shutil.ignore_patterns.
+    @param incremental          - Skip copying unchanged files on later installs.
+    @param checksum             - Compare file contents when installing incrementally.
+    @param copy_backend         - How files are copied when installing.
+
+    The clone in the cache is shared with other inhibitor processes.  Every
+    build holds the clone's lock shared for as long as it uses the clone, from
+    init() to finish().  It is only updated, or checked out at another
+    revision, under the lock held exclusively.
      """
 
     def __init__(self, src, inhibitor_state = None, dest = None, keep = False, rev = None, **keywds):
         self.env        = {}
         self.gitdir     = None
+        self.lock       = None
+        self.head       = None
         self.rev        = rev or 'HEAD'
         cachedirname    = src.split('/')[-1].rstrip('.git')
 
@@ -260,20 +317,24 @@ class GitSource(_GenericSource):
         super(GitSource, self).post_conf(inhibitor_status)
         self.gitdir = self.cachedir.pjoin('.git')
         self.env    = {'GIT_DIR':self.gitdir}
+        self.lock   = locks.Lock(self.cachedir + '.lock')
 
     def _get_remote_fetch(self):
         """
         Returns a list of origins we fetch from
         """
-        _, out = util.cmd_out('git remote -v', env=self.env)
         remotes = []
-        for line in out.splitlines():
+        for line in util.cmd_iter('git remote -v', env=self.env):
             _, tmp = line.split('\t')
             url, what = tmp.split(' ')
             if 'fetch' in what:
                 remotes.append(url)
         return remotes
 
+    def _head(self):
+        _, head = util.cmd_out('git rev-parse HEAD', env=self.env)
+        return head.strip()
+
     def clean_cache(self):
         if os.path.isdir(self.gitdir):
             if not self.src in self._get_remote_fetch():
@@ -286,7 +347,8 @@ class GitSource(_GenericSource):
             util.warn("Removing non - git clone %s" % (self.cachedir,))
             shutil.rmtree(self.cachedir)
 
-    def init(self):
+    def _update(self):
+        """Fetch the clone and check out rev, with the lock held exclusively."""
         self.clean_cache()
 
         if os.path.isdir(self.gitdir):
@@ -304,11 +366,26 @@ class GitSource(_GenericSource):
         if self.rev != 'HEAD':
             util.cmd('git checkout -b inhibitor %s' % self.rev, env=self.env, chdir=self.cachedir)
         else:
-            _, self.rev = util.cmd_out('git rev-parse HEAD', env=self.env)
-            self.rev = self.rev[:7]
+            self.rev = self._head()[:7]
+        self.head = self._head()
+
+    def init(self):
+        while True:
+            self.lock.acquire()
+            self._update()
+            # Converting drops the lock for a moment, another build may have
+            # checked out a different revision in between.
+            self.lock.acquire(shared=True)
+            if self._head() == self.head:
+                return
+            util.info("%s was updated by another build, updating it again"
+                % (self.cachedir,))
+
+    def identity(self):
+        return super(GitSource, self).identity() + [self.head]
 
     def finish(self):
-        self.clean_cache()
+        self.lock.release()
 
 
 class InhibitorScript(object):
@@ -347,6 +424,9 @@ class InhibitorScript(object):
             req.post_conf(inhibitor_state)
             req.init()
 
+    def identity(self):
+        return [self.local_src, self.script, self.args, self.reqs]
+
     def install(self, root):
         self.script.install(root)
         os.chmod(root.pjoin(self.local_src), 0755)
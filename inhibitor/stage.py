@@ -3,10 +3,16 @@ import util
 import glob
 import re
 import shutil
-import tarfile
 import types
+import cPickle
+import tempfile
 
 import actions
+import archive
+import chroot
+import locks
+import pkgstore
+import seeds
 import source
 
 def make_conf_source(**keywds):
@@ -36,6 +42,68 @@ def make_conf_source(**keywds):
     return ret
 
 
+# Ways of copying a seed into the build root.  Reflinks and hard links share the
+# file data with the seed, hard linked files must not be modified in place.
+SEED_CLONE = {
+    'copy':     None,
+    'reflink':  '--reflink=always',
+    'hardlink': '--link',
+}
+
+# Ways of checkpointing the build root.  btrfs snapshots need target_root to be
+# a subvolume, otherwise the root is copied with reflinks where the filesystem
+# supports them.
+CHECKPOINT = ('btrfs', 'reflink')
+
+def _is_subvolume(path):
+    """Return True if path is the top of a btrfs subvolume."""
+    if not os.path.isdir(path) or os.lstat(path).st_ino != 256:
+        return False
+    _, fstype = util.cmd_out('stat -f -c %%T %s' % (path,), raise_exception=False)
+    return fstype.strip() == 'btrfs'
+
+def _has_reflinks(directory):
+    """Return True if files in directory can be copied with reflinks."""
+    fd, src = tempfile.mkstemp(prefix='.reflink.', dir=directory)
+    try:
+        os.write(fd, 'reflink')
+        os.close(fd)
+        ret, _ = util.cmd_out('cp --reflink=always %s %s.copy' % (src, src),
+            raise_exception=False)
+    finally:
+        for path in (src, src + '.copy'):
+            if os.path.lexists(path):
+                os.unlink(path)
+    return ret == 0
+
+def _remove_tree(path):
+    if _is_subvolume(path):
+        util.cmd('btrfs subvolume delete %s' % (path,))
+    elif os.path.lexists(path):
+        shutil.rmtree(path)
+
+# Memory, in kB, set aside for each package built at once.
+EMERGE_JOB_MEMORY = 2 * 1024 * 1024
+
+# Seconds to wait for a background kernel build once the merges are done.
+KERNEL_BUILD_TIMEOUT = 6 * 3600
+
+def emerge_jobs(cpus=None):
+    """
+    Return the --jobs and --load-average for emerge on this host.  One package
+    is built per cpu, as long as each has EMERGE_JOB_MEMORY, and new builds
+    are held back while the load is above the number of cpus.
+
+    @param cpus     - Number of cpus to use, all of the host's by default.
+    """
+    if cpus == None:
+        cpus = util.cpu_count()
+    jobs = cpus
+    memory = util.mem_total()
+    if memory > 0:
+        jobs = min(jobs, memory // EMERGE_JOB_MEMORY)
+    return max(jobs, 1), float(max(cpus, 1))
+
 class BaseStage(actions.InhibitorAction):
     """
     Basic stage building action.  Handles fetching sources and setting up the chroot
@@ -44,11 +112,32 @@ class BaseStage(actions.InhibitorAction):
     @param stage_conf       - Stage configuration, see below.
     @param build_name       - Unique string to identify the stage.
     @param stage_name       - Type of stage being built.  Default is base_stage.
+    @param seed_overlay     - Rather than copying the unpacked seed into the build
+                              root, mount it read only as an overlayfs lower layer
+                              with the build's changes kept in a separate upper
+                              layer.  Builds sharing a seed then share a single
+                              copy of it (False).
+    @param seed_clone       - How the seed is copied into the build root when not
+                              using seed_overlay, one of SEED_CLONE (copy).
+    @param checkpoint       - Copy the build root after the steps that change it
+                              the most.  A resumed build whose step failed or
+                              changed then restarts from the last copy rather
+                              than a partly modified root.  One of CHECKPOINT,
+                              or None to not checkpoint (None).  With
+                              seed_overlay only the upper layer is copied.
+                              Checkpoints are only cheap with reflinks, so
+                              checkpointing is turned off if the build
+                              directory's filesystem does not support them.
 
     Stage Configuration:
         @param name         -
         @param seed         - Name of the seed stage to use for building.  Stage
-                              needs to be located in inhibitor's stagedir.
+                              needs to be located in inhibitor's stagedir.  May
+                              also be another BaseStage that has already run, in
+                              which case its finished root is used directly.
+        @param pack         - Pack the finished stage into an archive (True).
+                              Not needed for stages only used as another stage's
+                              seed.
         @param fs_sources   - List of InhibitorSources to be added to the stage.  The
                               sources are added during install_sources().  If
                               source.keep is set, the source will persist in the file
@@ -56,7 +145,8 @@ class BaseStage(actions.InhibitorAction):
                               remove_sources().
 
     """
-    def __init__(self, stage_conf, build_name, stage_name='base_stage', **keywds):
+    def __init__(self, stage_conf, build_name, stage_name='base_stage', seed_overlay=False,
+            seed_clone='copy', checkpoint=None, **keywds):
         self.build_name     = '%s-%s' %  (stage_name, build_name)
         self.conf           = stage_conf
         self.sources        = []
@@ -64,6 +154,14 @@ class BaseStage(actions.InhibitorAction):
         self.target_root    = None
         self.tarpath        = None
         self.seed           = None
+        self.seed_overlay   = seed_overlay
+        self.seed_clone     = seed_clone
+        self.seed_action    = None
+        self.seed_mount     = None
+        self.pack_stage     = True
+        self.layerdir       = None
+        self.checkpoint     = checkpoint
+        self.checkpointdir  = None
         self.fs_sources     = None
         self.aux_mounts     = {}
         self.aux_sources    = {}
@@ -78,6 +176,18 @@ class BaseStage(actions.InhibitorAction):
             self.seed = self.conf.seed
         else:
             raise util.InhibitorError('No seed stage specified')
+        if isinstance(self.seed, BaseStage):
+            self.seed_action = self.seed
+
+        if self.conf.has('pack'):
+            self.pack_stage = self.conf.pack
+
+        if not seed_clone in SEED_CLONE:
+            raise util.InhibitorError("Unknown seed_clone '%s', expected one of %s"
+                % (seed_clone, ', '.join(sorted(SEED_CLONE.keys()))))
+        if checkpoint != None and not checkpoint in CHECKPOINT:
+            raise util.InhibitorError("Unknown checkpoint '%s', expected one of %s"
+                % (checkpoint, ', '.join(CHECKPOINT)))
 
         super(BaseStage, self).__init__(self.build_name, **keywds)
 
@@ -86,14 +196,25 @@ class BaseStage(actions.InhibitorAction):
         self.env['ROOT'] = new_root
 
     def chroot_failure(self):
+        chroot.stop_workers()
         util.umount_all(self.istate.mount_points)
 
     def post_conf_begin(self, inhibitor_state):
         super(BaseStage, self).post_conf(inhibitor_state)
         self.target_root    = self.istate.paths.build.pjoin(self.build_name)
-        self.tarpath        = self.istate.paths.stages.pjoin(self.build_name + '.tar.bz2')
-        util.mkdir(self.target_root)
-        if self.seed:
+        self.layerdir       = self.istate.paths.build.pjoin(self.build_name + '.layer')
+        self.checkpointdir  = self.istate.paths.build.pjoin(self.build_name + '.checkpoints')
+        self.tarpath        = archive.tarpath(
+            self.istate.paths.stages.pjoin(self.build_name), self.compression)
+        if self.checkpoint != None and not _has_reflinks(util.mkdir(self.istate.paths.build)):
+            util.warn("Not checkpointing, %s does not support reflinks and every "
+                "checkpoint would be a full copy of the build root" % (self.istate.paths.build,))
+            self.checkpoint = None
+        if not os.path.exists(self.target_root):
+            self.make_root()
+        if self.seed_action:
+            self.seed       = self.istate.paths.build.pjoin(self.seed_action.build_name)
+        elif self.seed:
             self.seed       = self.istate.paths.stages.pjoin(self.seed)
 
         self.aux_mounts = {
@@ -144,22 +265,239 @@ class BaseStage(actions.InhibitorAction):
         if run_finish:
             self.post_conf_finish()
 
-    def unpack_seed(self):
-        if not os.path.isdir(self.seed):
-            if os.path.exists(self.seed):
-                os.unlink(self.seed)
-            seedfile = self.seed + '.tar.bz2'
-            util.info("Unpacking %s" % seedfile)
-            os.makedirs(self.seed)
-            try:
-                util.cmd('tar -xjpf %s -C %s/' % (seedfile, self.seed))
-            except:
-                shutil.rmtree(self.seed)
-                raise
+    def dependencies(self):
+        if self.seed_action:
+            return [self.seed_action]
+        return []
+
+    def fingerprint_inputs(self, exclude):
+        conf = {}
+        for k in set(self.conf.keys):
+            if not k in exclude:
+                conf[k] = getattr(self.conf, k)
+        return super(BaseStage, self).fingerprint_inputs(exclude) + [
+            conf, self.sources, self.seed_identity(), self.seed_overlay, self.seed_clone]
+
+    def step_inputs(self, step):
+        return [(k, getattr(self.conf, k)) for k in step.conf_keys if self.conf.has(k)]
+
+    def seed_identity(self):
+        """Return what identifies the contents of the seed."""
+        if self.seed_action:
+            return actions.load_fingerprints(
+                self.istate.paths.state.pjoin(self.seed_action.name)).get(None)
+        seedfile = archive.find_tarball(self.seed)
+        if seedfile == None:
+            return self.seed
+        return seeds.SeedCache(self.seed).digest(seedfile)
+
+    def resume_valid(self):
+        if self.seed_overlay:
+            return os.path.isdir(self.layerdir.pjoin('upper'))
+        return len(os.listdir(self.target_root)) > 0
+
+    def mount_roots(self, istate):
+        build = istate.paths.build
+        return [build.pjoin(self.build_name),
+            build.pjoin(self.build_name + '.layer.seed'),
+            build.pjoin(self.build_name + '.checkpoints')]
+
+    def root_layers(self, istate):
+        """
+        Return the directories, topmost first, that make up the finished root
+        of this stage, for use as the seed of another stage.  This only depends
+        on the configuration so it also works when the stage ran in another
+        process.
+        """
+        if not self.seed_overlay:
+            return [istate.paths.build.pjoin(self.build_name)]
+
+        layers = [istate.paths.build.pjoin(self.build_name + '.layer', 'upper')]
+        if self.seed_action:
+            layers.extend(self.seed_action.root_layers(istate))
+        else:
+            layers.append(istate.paths.stages.pjoin(self.conf.seed))
+        return layers
+
+    def seed_layers(self):
+        """Return the read only directories, topmost first, the seed is made of."""
+        if not self.seed_action:
+            return [self.seed]
 
-        util.info("Syncing %s to %s" % (self.seed.dname(), self.target_root.dname()) )
-        util.cmd('rsync -a --delete %s %s' %
-            (self.seed.dname(), self.target_root.dname()) )
+        layers = self.seed_action.root_layers(self.istate)
+        for layer in layers:
+            if not os.path.isdir(layer):
+                raise util.InhibitorError("Seed %s has not been built, %s is missing"
+                    % (self.seed_action.build_name, layer))
+        return layers
+
+    def unpack_seed(self):
+        if not self.seed_action:
+            seeds.SeedCache(self.seed).update()
+
+        if self.seed_overlay:
+            # A new build starts with an empty upper layer.
+            self.umount_seed()
+            if os.path.exists(self.layerdir):
+                shutil.rmtree(self.layerdir)
+            self.mount_seed()
+            return
+
+        layers = self.seed_layers()
+        if len(layers) == 1:
+            self.clone_seed(layers[0])
+            return
+
+        # The seed is itself a stack of layers, copy the merged view of them.
+        # Files cannot be linked across the overlay, so they are always copied.
+        if self.seed_clone != 'copy':
+            util.warn("Cannot %s %s, it is an overlay, copying it instead." % (
+                self.seed_clone, self.seed_action.build_name))
+        view = util.Path(self.layerdir + '.seed')
+        mp = util.Mount('overlay', '/', view)
+        util.mkdir(view)
+        util.mount(mp, self.istate.mount_points,
+            options = '-t overlay -o ro,lowerdir=%s' % (':'.join(layers),))
+        try:
+            self.clone_seed(view, 'copy')
+        finally:
+            util.umount(mp, self.istate.mount_points)
+        os.rmdir(view)
+
+    def clone_seed(self, src, method=None):
+        """
+        Replace target_root with a copy of src made with method, one of
+        SEED_CLONE, defaulting to seed_clone.
+        """
+        if method == None:
+            method = self.seed_clone
+        if not util.umount_under(self.target_root):
+            # Removing the old root would reach into the host through them.
+            raise util.InhibitorError("Cannot replace %s, it still has mounts under it"
+                % (self.target_root,))
+        src = util.Path(src)
+        util.info("Cloning %s to %s" % (src.dname(), self.target_root.dname()) )
+        if SEED_CLONE[method] == None:
+            util.cmd('rsync -a --delete %s %s' %
+                (src.dname(), self.target_root.dname()) )
+        else:
+            _remove_tree(self.target_root)
+            self.make_root()
+            util.cmd('cp -a %s %s %s' %
+                (SEED_CLONE[method], src.dname() + '.', self.target_root.dname()) )
+
+    def make_root(self):
+        """
+        Create an empty target_root, as a btrfs subvolume when checkpointing
+        with btrfs so that it can be snapshotted.
+        """
+        if self.checkpoint == 'btrfs' and not self.seed_overlay:
+            parent = os.path.dirname(self.target_root)
+            util.mkdir(parent)
+            _, fstype = util.cmd_out('stat -f -c %%T %s' % (parent,), raise_exception=False)
+            if fstype.strip() == 'btrfs':
+                util.cmd('btrfs subvolume create %s' % (self.target_root,))
+                return
+        os.makedirs(self.target_root)
+
+    def _checkpoint_root(self):
+        """Return the directory holding the changes made to the build root."""
+        if self.seed_overlay:
+            return self.layerdir.pjoin('upper')
+        return self.target_root
+
+    def _snapshot_root(self, dest, btrfs=False):
+        """
+        Copy the changes made to the build root, see _checkpoint_root(), to
+        dest.  With btrfs set and the root a subvolume the copy is a read only
+        snapshot, otherwise it is copied with reflinks where the filesystem
+        supports them.  Submounts such as /proc and the sources are left out by
+        copying a non recursive bind mount of the root.
+        """
+        src = self._checkpoint_root()
+        _remove_tree(dest)
+        if btrfs and _is_subvolume(src):
+            util.cmd('btrfs subvolume snapshot -r %s %s' % (src, dest))
+            return
+
+        tmp = util.Path(dest + '.tmp')
+        _remove_tree(tmp)
+        view = None
+        if not self.seed_overlay:
+            view = util.Mount(src, '/', util.Path(dest + '.view'))
+            util.mkdir(view.root)
+            util.mount(view, self.istate.mount_points)
+            src = view.root
+        try:
+            util.cmd('cp -a --reflink=auto %s %s' % (src, tmp))
+        finally:
+            if view != None:
+                util.umount(view, self.istate.mount_points)
+                os.rmdir(view.root)
+        os.rename(tmp, dest)
+
+    def save_checkpoint(self, fingerprint, keep):
+        """
+        Snapshot target_root into checkpointdir, or copy it with reflinks if
+        it is not a btrfs subvolume, see _snapshot_root().
+        """
+        if self.checkpoint == None:
+            return
+        util.mkdir(self.checkpointdir)
+        util.info("Checkpointing %s" % (self._checkpoint_root(),))
+        self._snapshot_root(self.checkpointdir.pjoin(fingerprint),
+            btrfs=self.checkpoint == 'btrfs')
+
+        for name in os.listdir(self.checkpointdir):
+            if not name in keep:
+                util.dbg("Removing stale checkpoint %s" % (name,))
+                _remove_tree(self.checkpointdir.pjoin(name))
+
+    def load_checkpoint(self, fingerprint):
+        """Replace target_root with the checkpoint saved under fingerprint."""
+        src = self.checkpointdir.pjoin(fingerprint)
+        if self.checkpoint == None or not os.path.isdir(src):
+            return False
+        dest = self._checkpoint_root()
+        util.info("Restoring %s from checkpoint %s" % (dest, src))
+
+        if not util.umount_under(self.target_root):
+            raise util.InhibitorError("Cannot restore %s, it still has mounts under it"
+                % (self.target_root,))
+        _remove_tree(dest)
+        if _is_subvolume(src):
+            util.cmd('btrfs subvolume snapshot %s %s' % (src, dest))
+        else:
+            util.cmd('cp -a --reflink=auto %s %s' % (src, dest))
+        if self.seed_overlay:
+            _remove_tree(self.layerdir.pjoin('work'))
+        return True
+
+    def mount_seed(self):
+        """
+        Mount the unpacked seed as the read only lower layer of target_root when
+        using seed_overlay.  Changes made in target_root go to the upper layer in
+        layerdir, which persists across unmounts so that builds can be resumed.
+        """
+        if not self.seed_overlay or self.seed_mount in self.istate.mount_points:
+            return
+        if not self.seed_action:
+            # Keep other processes from evicting the seed while it is mounted.
+            seeds.SeedCache(self.seed).hold()
+        lower   = ':'.join(self.seed_layers())
+        upper   = util.mkdir(self.layerdir.pjoin('upper'))
+        work    = util.mkdir(self.layerdir.pjoin('work'))
+        util.info("Mounting %s under %s" % (lower, self.target_root))
+        self.seed_mount = util.Mount('overlay', '/', self.target_root)
+        util.mount(self.seed_mount, self.istate.mount_points,
+            options = '-t overlay -o lowerdir=%s,upperdir=%s,workdir=%s' % (
+                lower, upper, work))
+
+    def umount_seed(self):
+        """Unmount the seed layer mounted by mount_seed."""
+        if self.seed_mount != None:
+            util.umount(self.seed_mount, self.istate.mount_points)
+            self.seed_mount = None
 
     def install_sources(self):
         for src in self.sources:
@@ -171,6 +509,9 @@ class BaseStage(actions.InhibitorAction):
             self.aux_sources[m].install( root = self.target_root )
 
     def remove_sources(self):
+        # Nothing runs in the chroot from here on.
+        chroot.stop_workers()
+
         for src in [x for x in self.sources if (x.keep and not x.mountable)]:
             # Previous actions may have overwritten the source, so
             # it needs to be reinstalled one last time.
@@ -195,19 +536,14 @@ class BaseStage(actions.InhibitorAction):
 
     def get_action_sequence(self):
         return [
-            util.Step(self.install_sources,     always=True),
-            util.Step(self.remove_sources,      always=True),
+            util.Step(self.install_sources,     always=True, resource='mount'),
+            util.Step(self.remove_sources,      always=True, resource='mount'),
             util.Step(self.finish_sources,      always=True),
             util.Step(self.clean_tmp,           always=True),
         ]
 
     def pack(self):
-        archive = tarfile.open(self.tarpath, 'w:bz2')
-        archive.add(self.target_root,
-            arcname = '/',
-            recursive = True,
-        )
-        archive.close()
+        archive.pack_tree(self.target_root, self.tarpath, self.compression)
         util.info("Created %s" % (self.tarpath,))
 
 
@@ -236,13 +572,25 @@ class BaseGentooStage(BaseStage):
                               needs to be located in inhibitor's stagedir.
         @param make_conf    - InhibitorSource for make.conf.
         @param portage_conf - InhibitorSource with the contents for /etc/portage.
+        @param pkgcache     - InhibitorSource to use as PKGDIR rather than a
+                              directory of the stage's own.
 
+    @param pkg_store        - Use the binary packages built by any stage with the
+                              same CHOST, flags, USE and profile, kept in
+                              paths.pkgs/.store, and add the packages this stage
+                              builds to them.  Ignores pkgcache (False).
     """
-    def __init__(self, stage_conf, build_name, stage_name='base_stage', **keywds):
+    def __init__(self, stage_conf, build_name, stage_name='base_stage', pkg_store=False,
+            **keywds):
         super(BaseGentooStage, self).__init__(stage_conf, build_name, stage_name=stage_name, **keywds)
         self.profile        = None
         self.kernel         = None
         self.pkgcache       = None
+        self.pkg_store      = pkg_store
+        self.pkg_partition  = None
+        self.pkg_mount      = None
+        self.pkg_log_offset = 0
+        self.pkg_stats      = None
 
         self.portage_cr     = util.Path('/tmp/inhibitor/portage_configroot')
         self.env.update({
@@ -265,16 +613,24 @@ class BaseGentooStage(BaseStage):
 
     def post_conf(self, inhibitor_state):
         super(BaseGentooStage, self).post_conf(inhibitor_state, run_finish=False)
-        if not self.pkgcache:
-            self.pkgcache = source.create_source(
-                "file://%s" % util.mkdir(self.istate.paths.pkgs.pjoin(self.build_name)) )
-        self.pkgcache.keep = False
-        self.pkgcache.dest = self.env['PKGDIR']
-        self.sources.append(self.pkgcache)
+        if self.pkg_store:
+            # PKGDIR is mounted by mount_pkg_store().
+            if self.pkgcache:
+                util.warn("Ignoring pkgcache, using the shared package store")
+            self.pkgcache = None
+        else:
+            if not self.pkgcache:
+                self.pkgcache = source.create_source(
+                    "file://%s" % util.mkdir(self.istate.paths.pkgs.pjoin(self.build_name)) )
+            self.pkgcache.keep = False
+            self.pkgcache.cache = True
+            self.pkgcache.dest = self.env['PKGDIR']
+            self.sources.append(self.pkgcache)
 
         distcache = source.create_source(
             "file://%s" % util.mkdir(self.istate.paths.dist),
             keep = False,
+            cache = True,
             dest = self.env['DISTDIR']
         )
         self.sources.append(distcache)
@@ -294,6 +650,7 @@ class BaseGentooStage(BaseStage):
             kerncache = source.create_source(
                 "file://%s" % util.mkdir(inhibitor_state.paths.kernel.pjoin(self.build_name)),
                 keep = False,
+                cache = True,
                 dest = '/tmp/inhibitor/kerncache'
             )
             self.sources.append(kerncache)
@@ -350,6 +707,66 @@ class BaseGentooStage(BaseStage):
                 os.unlink(targ)
             os.symlink(self.env['PORTDIR'] + '/profiles/%s' % self.profile, targ)
 
+    def mount_pkg_store(self):
+        """
+        Mount the partition of the shared package store matching the settings
+        of the stage read only at PKGDIR, with the packages the stage builds
+        going to its own directory in paths.pkgs.
+        """
+        if not self.pkg_store or self.pkg_mount in self.istate.mount_points:
+            return
+        _, output = chroot.run(
+            path = self.target_root,
+            function = util.cmd_out,
+            fargs = {
+                'cmdline': 'portageq envvar %s' % (' '.join(pkgstore.COMPAT_VARS),),
+                'env': self.env
+            },
+            failuref = self.chroot_failure
+        )
+        # portageq ends every value with a newline, empty ones included.
+        values = output.split('\n')
+        if values[-1] == '':
+            values.pop()
+        if len(values) != len(pkgstore.COMPAT_VARS):
+            raise util.InhibitorError("Unexpected output from portageq: %s" % (output,))
+        settings = dict(zip(pkgstore.COMPAT_VARS, values))
+        settings['profile'] = self.profile
+
+        store = pkgstore.PackageStore(self.istate.paths.pkgs.pjoin('.store'))
+        self.pkg_partition = store.partition(settings)
+        upper   = util.mkdir(self.istate.paths.pkgs.pjoin(self.build_name))
+        work    = util.mkdir(self.istate.paths.pkgs.pjoin(self.build_name + '.work'))
+        util.info("Using binary packages from %s" % (self.pkg_partition,))
+        self.pkg_mount = util.Mount('overlay', self.env['PKGDIR'], self.target_root)
+        util.mount(self.pkg_mount, self.istate.mount_points,
+            options = '-t overlay -o lowerdir=%s,upperdir=%s,workdir=%s' % (
+                self.pkg_partition, upper, work))
+        self.pkg_log_offset = pkgstore.log_offset(self.target_root.pjoin('/var/log/emerge.log'))
+
+    def publish_packages(self):
+        """
+        Unmount the package store and add the packages built by the stage to
+        it.  Counts the packages merged from it and built from source.
+        """
+        if self.pkg_mount == None:
+            return
+        util.umount(self.pkg_mount, self.istate.mount_points)
+        self.pkg_mount = None
+        store = pkgstore.PackageStore(self.istate.paths.pkgs.pjoin('.store'))
+        published = store.publish(self.pkg_partition,
+            self.istate.paths.pkgs.pjoin(self.build_name))
+        binary, built = pkgstore.merge_counts(
+            self.target_root.pjoin('/var/log/emerge.log'), self.pkg_log_offset)
+        self.pkg_stats = util.Container(hits=binary, misses=built, published=published)
+
+    def report_packages(self):
+        if self.pkg_stats == None:
+            return
+        util.info("Binary packages: %d reused, %d built, %d added to %s" % (
+            self.pkg_stats.hits, self.pkg_stats.misses, self.pkg_stats.published,
+            self.pkg_partition))
+
     def restore_profile_link(self):
         # XXX:  See make_profile_link.
         targ = self.target_root.pjoin('/etc/make.profile')
@@ -359,9 +776,11 @@ class BaseGentooStage(BaseStage):
 
     def get_action_sequence(self):
         return [
-            util.Step(self.install_sources,     always=True),
+            util.Step(self.install_sources,     always=True, resource='mount'),
             util.Step(self.make_profile_link,   always=True),
-            util.Step(self.remove_sources,      always=True),
+            util.Step(self.mount_pkg_store,     always=True, resource='mount'),
+            util.Step(self.publish_packages,    always=True, resource='io'),
+            util.Step(self.remove_sources,      always=True, resource='mount'),
             util.Step(self.finish_sources,      always=True),
             util.Step(self.restore_profile_link,always=True),
             util.Step(self.clean_tmp,           always=True),
@@ -377,6 +796,22 @@ class Stage4(BaseGentooStage):
     @param stage_conf       - Stage configuration, see below.
     @param build_name       - Unique string to identify the stage.
     @param stage_name       - Type of stage being built.  Default is base_stage.
+    @param unified_merge    - Merge the system set and the packages with a single
+                              emerge, building as many packages at once as the
+                              host's cpus and memory allow, see emerge_jobs().
+                              The order and duration of each merge are kept in
+                              the state directory (False).
+    @param kernel_pipeline  - Build the kernel in the background while the
+                              packages are merged, when the kernel has no
+                              packages to merge after it and unified_merge is not
+                              set.  The build starts once the system set is
+                              merged, in an overlay over a copy of the build
+                              root, and is joined before the kernel is installed
+                              (False).
+    @param kernel_cpus      - Number of cpus the background kernel build uses,
+                              the merges get the rest (half of the host's).
+    @param kernel_timeout   - Seconds to wait for the background kernel build
+                              after the merges (KERNEL_BUILD_TIMEOUT).
 
     Stage Configuration:
         @param name         -
@@ -391,7 +826,10 @@ class Stage4(BaseGentooStage):
                               kernel has been configured.
         @param profile      - Portage profile to use.
         @param seed         - Name of the seed stage to use for building.  Stage
-                              needs to be located in inhibitor's stagedir.
+                              needs to be located in inhibitor's stagedir.  May
+                              also be another BaseStage that has already run, in
+                              which case its finished root is used directly.
+        @param pack         - Pack the finished stage into an archive (True).
         @param make_conf    - InhibitorSource for make.conf.
         @param portage_conf - InhibitorSource with the contents for /etc/portage.
 
@@ -400,9 +838,15 @@ class Stage4(BaseGentooStage):
                               completed chroot from '/tmp/inhibitor/sh/'
         @param packages     - List or String of packages to merge.
     """
-    def __init__(self, stage_conf, build_name, **keywds):
+    def __init__(self, stage_conf, build_name, unified_merge=False, kernel_pipeline=False,
+            kernel_cpus=None, kernel_timeout=KERNEL_BUILD_TIMEOUT, **keywds):
         self.package_list   = []
         self.scripts        = []
+        self.unified_merge  = unified_merge
+        self.kernel_pipeline = kernel_pipeline
+        self.kernel_cpus    = kernel_cpus
+        self.kernel_timeout = kernel_timeout
+        self.kernel_job     = None
 
         super(Stage4, self).__init__(stage_conf, build_name, 'stage4', **keywds)
         self.emerge_cmd     = '%s/inhibitor-run.sh run_emerge ' % (self.env['INHIBITOR_SCRIPT_ROOT'],)
@@ -420,8 +864,21 @@ class Stage4(BaseGentooStage):
         else:
             raise util.InhibitorError('No packages specified')
 
+        if self.kernel_pipeline and self.kernel and self.kernel.has('packages') \
+                and util.strlist_to_list(self.kernel.packages):
+            util.warn("Not building the kernel in the background, it has packages to merge")
+            self.kernel_pipeline = False
+        if self.kernel_pipeline and self.unified_merge:
+            util.warn("Not building the kernel in the background, the system set is merged with the packages")
+            self.kernel_pipeline = False
+
+    def mount_roots(self, istate):
+        return super(Stage4, self).mount_roots(istate) + [
+            istate.paths.build.pjoin(self.build_name + '.kernel')]
+
     def _emerge(self, packages, flags=''):
-        util.chroot(
+        self._poll_kernel()
+        chroot.run(
             path = self.target_root,
             function = util.cmd,
             fargs = {
@@ -437,29 +894,60 @@ class Stage4(BaseGentooStage):
 
     def get_action_sequence(self):
         ret = []
-        ret.append( util.Step(self.unpack_seed,             always=False)   )
-        ret.append( util.Step(self.install_sources,         always=True)    )
+        ret.append( util.Step(self.unpack_seed,             always=False,
+            resource='io')                                                  )
+        ret.append( util.Step(self.mount_seed,              always=True,
+            resource='mount')                                               )
+        ret.append( util.Step(self.install_sources,         always=True,
+            resource='mount')                                               )
         ret.append( util.Step(self.make_profile_link,       always=False)   )
-        ret.append( util.Step(self.merge_portage,           always=False)   )
+        ret.append( util.Step(self.mount_pkg_store,         always=True,
+            resource='mount')                                               )
+        ret.append( util.Step(self.merge_portage,           always=False,
+            resource='cpu')                                                 )
         ret.append( util.Step(self.setup_extras,            always=False)   )
-        ret.append( util.Step(self.merge_system,            always=False)   )
-        ret.append( util.Step(self.merge_packages,          always=False)   )
+        pipeline = self.kernel and self.kernel_pipeline
+        if self.unified_merge:
+            ret.append( util.Step(self.merge_world,         always=False,
+                conf_keys=('packages',), checkpoint=True, resource='cpu')   )
+        else:
+            ret.append( util.Step(self.merge_system,        always=False,
+                checkpoint=True, resource='cpu')                            )
+            if pipeline:
+                ret.append( util.Step(self.start_kernel,    always=True)    )
+            ret.append( util.Step(self.merge_packages,      always=False,
+                conf_keys=('packages',), checkpoint=True, resource='cpu')   )
+        if pipeline:
+            ret.append( util.Step(self.join_kernel,         always=True)    )
         if self.kernel:
-            ret.append( util.Step(self.merge_kernel,        always=False)   )
-        ret.append( util.Step(self.run_scripts,             always=False)   )
-        ret.append( util.Step(self.remove_sources,          always=True)    )
+            ret.append( util.Step(self.merge_kernel,        always=False,
+                conf_keys=('kernel',), checkpoint=True, resource='cpu')     )
+        ret.append( util.Step(self.run_scripts,             always=False,
+            conf_keys=('scripts',))                                         )
+        ret.append( util.Step(self.publish_packages,        always=True,
+            resource='io')                                                  )
+        ret.append( util.Step(self.remove_sources,          always=True,
+            resource='mount')                                               )
         ret.append( util.Step(self.finish_sources,          always=True)    )
         ret.append( util.Step(self.install_portage_conf,    always=False)   )
         ret.append( util.Step(self.restore_profile_link,    always=True)    )
         ret.append( util.Step(self.clean_tmp,               always=True)    )
-        ret.append( util.Step(self.pack,                    always=False)   )
+        if self.pack_stage:
+            ret.append( util.Step(self.pack,                always=False,
+                resource='io')                                              )
+        ret.append( util.Step(self.umount_seed,             always=True,
+            resource='mount')                                               )
+        ret.append( util.Step(self.final_report,            always=True)    )
         return ret
 
+    def final_report(self):
+        self.report_packages()
+
     def merge_portage(self):
         self._emerge('sys-apps/portage', flags='--oneshot --newuse')
 
     def setup_extras(self):
-        util.chroot(
+        chroot.run(
             path = self.target_root,
             function = util.cmd,
             fargs = {
@@ -477,7 +965,55 @@ class Stage4(BaseGentooStage):
         package_str = package_str.replace('\n', ' ')
         self._emerge(package_str, flags='--deep --newuse --update')
 
-    def merge_kernel(self):
+    def merge_world(self):
+        """
+        Merge the system set and the packages together, so that packages
+        unrelated to the system set do not wait for all of it to finish.
+        """
+        jobs, load = emerge_jobs()
+        util.info("Merging with %d jobs up to a load of %.1f" % (jobs, load))
+        package_str = ' '.join(self.package_list)
+        package_str = package_str.replace('\n', ' ')
+
+        log = self.target_root.pjoin('/var/log/emerge.log')
+        offset = pkgstore.log_offset(log)
+        self._emerge('system ' + package_str,
+            flags='--deep --newuse --update --jobs=%d --load-average=%.1f' % (jobs, load))
+        self.record_merge_times(pkgstore.merge_times(log, offset))
+
+    def record_merge_times(self, times):
+        """
+        Save the (cpv, start, seconds) of each package merged to the state
+        directory and report the slowest ones, along with how long they took
+        the last time they were merged.
+        """
+        path = self.statedir.pjoin('merge_times')
+        previous = {}
+        if os.path.exists(path):
+            f = open(path, 'rb')
+            try:
+                for cpv, _, seconds in cPickle.load(f):
+                    previous[cpv] = seconds
+            finally:
+                f.close()
+
+        tmp = locks.temp_path(path)
+        f = open(tmp, 'wb')
+        cPickle.dump(times, f, 2)
+        f.close()
+        locks.publish(tmp, path)
+
+        if len(times) == 0:
+            return
+        util.info("Merged %d packages in %ds" % (len(times),
+            max([start + seconds for _, start, seconds in times]) - times[0][1]))
+        for cpv, _, seconds in sorted(times, key=lambda t: t[2], reverse=True)[:5]:
+            if cpv in previous:
+                util.info("    %s took %ds, %ds last time" % (cpv, seconds, previous[cpv]))
+            else:
+                util.info("    %s took %ds" % (cpv, seconds))
+
+    def _kernel_cmdline(self, extra_args=[]):
         args = ['--build_name', self.build_name,
             '--kernel_pkg', '\'%s\'' % (self.kernel.kernel_pkg,)]
 
@@ -485,21 +1021,161 @@ class Stage4(BaseGentooStage):
             args.extend(['--genkernel', self.kernel.genkernel])
         if self.kernel.has('packages'):
             args.extend(['--packages', self.kernel.packages])
+        args.extend(extra_args)
+        return '%s/kernel.sh %s' % ( self.env['INHIBITOR_SCRIPT_ROOT'], ' '.join(args),)
 
-        util.chroot(
+    def merge_kernel(self):
+        chroot.run(
             path = self.target_root,
             function = util.cmd,
             fargs = {
-                'cmdline': '%s/kernel.sh %s' % ( self.env['INHIBITOR_SCRIPT_ROOT'], ' '.join(args),),
+                'cmdline': self._kernel_cmdline(),
                 'env': self.env
             },
             failuref = self.chroot_failure,
         )
 
+    def start_kernel(self):
+        """
+        Start building the kernel into the kernel cache while the packages are
+        merged.  The build runs in a chroot worker of its own, in an overlay
+        over a copy of the build root taken after the system set is merged, so
+        that the merges cannot change its toolchain underneath it.  The mounts
+        of the build root, such as /proc and the sources, are bound into the
+        overlay as well.  merge_kernel() then installs the cached build.
+
+        Nothing is started if merge_kernel() is not going to run or the kernel
+        cache already holds a build of the kernel.  While the kernel builds, the
+        merges are held to the cpus it leaves idle with a load average limit in
+        MAKEOPTS, so they get all of them back as soon as the build is done.
+        """
+        if not 'merge_kernel' in self.pending_steps:
+            return
+        if chroot.run(self.target_root, util.cmd, failuref=self.chroot_failure,
+                fargs={
+                    'cmdline':  self._kernel_cmdline(['--check_cached']),
+                    'env':      self.env,
+                    'raise_exception':  False,
+                }) == 0:
+            util.info("The kernel is already cached, not building it in the background")
+            return
+
+        cpus = util.cpu_count()
+        kernel_cpus = self.kernel_cpus or max(cpus // 2, 1)
+        util.info("Building the kernel with %d cpus, merging up to a load of %d" % (
+            kernel_cpus, cpus))
+
+        kerneldir = self.istate.paths.build.pjoin(self.build_name + '.kernel')
+        if not util.umount_under(kerneldir):
+            raise util.InhibitorError("Cannot replace %s, it still has mounts under it"
+                % (kerneldir,))
+        _remove_tree(kerneldir)
+        util.mkdir(kerneldir)
+
+        job = util.Container(
+            dir         = kerneldir,
+            root        = util.mkdir(kerneldir.pjoin('root')),
+            mounts      = [],
+            result      = None,
+            checkpoint  = None,
+            makeopts    = self.env.get('MAKEOPTS'))
+        self.kernel_job = job
+
+        util.info("Copying %s for the kernel build" % (self._checkpoint_root(),))
+        self._snapshot_root(kerneldir.pjoin('lower'), btrfs=True)
+        lower = [kerneldir.pjoin('lower')]
+        if self.seed_overlay:
+            lower.extend(self.seed_layers())
+        mp = util.Mount('overlay', '/', job.root)
+        util.mount(mp, self.istate.mount_points,
+            options = '-t overlay -o lowerdir=%s,upperdir=%s,workdir=%s' % (
+                ':'.join(lower), util.mkdir(kerneldir.pjoin('upper')),
+                util.mkdir(kerneldir.pjoin('work'))))
+        job.mounts.append(mp)
+
+        top = os.path.realpath(self.target_root)
+        for path in util.mount_points():
+            if not path.startswith(top + '/'):
+                continue
+            mp = util.Mount(path, path[len(top):], job.root)
+            dest = mp.root.pjoin(mp.dest)
+            if not os.path.isdir(path) and not os.path.lexists(dest):
+                open(dest, 'a').close()
+            util.mount(mp, self.istate.mount_points)
+            job.mounts.append(mp)
+
+        fargs = {
+            'cmdline':  self._kernel_cmdline(['--build_only', '--jobs', str(kernel_cpus)]),
+            'env':      dict(self.env),
+        }
+        self.env['MAKEOPTS'] = '-j%d -l%d' % (cpus, cpus)
+        job.worker = chroot.get_worker(job.root)
+        job.worker.submit([(util.cmd, fargs)])
+
+    def _poll_kernel(self):
+        """
+        Collect the background kernel build if it has finished, putting back the
+        MAKEOPTS it limited.
+        """
+        job = self.kernel_job
+        if job == None or job.result != None or not job.worker.ready():
+            return
+        job.result = job.worker.collect()[-1]
+        self._restore_makeopts(job)
+
+    def _restore_makeopts(self, job):
+        if job.makeopts == None:
+            self.env.pop('MAKEOPTS', None)
+        else:
+            self.env['MAKEOPTS'] = job.makeopts
+
+    def join_kernel(self):
+        """
+        Wait up to kernel_timeout seconds for the kernel build started by
+        start_kernel(), remove its root and save the checkpoint held back while
+        it ran.
+        """
+        job = self.kernel_job
+        if job == None:
+            return
+        try:
+            if job.result == None:
+                util.info("Waiting for the kernel build to finish")
+                job.result = job.worker.collect(self.kernel_timeout)[-1]
+        finally:
+            self.kernel_job = None
+            self._restore_makeopts(job)
+            chroot.stop_workers(job.root)
+            for mp in reversed(job.mounts):
+                util.umount(mp, self.istate.mount_points)
+            if not util.umount_under(job.dir):
+                raise util.InhibitorError("Cannot remove %s, it still has mounts under it"
+                    % (job.dir,))
+            _remove_tree(job.dir.pjoin('lower'))
+            _remove_tree(job.dir)
+
+        if job.checkpoint != None:
+            self.save_checkpoint(*job.checkpoint)
+        status, value = job.result
+        if status == 'error':
+            message, tb = value
+            util.dbg(tb)
+            raise util.InhibitorError("Kernel build failed: %s" % (message,))
+
+    def save_checkpoint(self, fingerprint, keep):
+        """
+        Hold checkpoints back while the kernel is being built from a copy of
+        the build root, join_kernel() saves the latest one once it is done.
+        """
+        if self.kernel_job != None:
+            self.kernel_job.checkpoint = (fingerprint, keep)
+            return
+        super(Stage4, self).save_checkpoint(fingerprint, keep)
+
     def run_scripts(self):
         for script in self.scripts:
             script.install( root = self.target_root )
-            util.chroot(
+            chroot.run(
                 path = self.target_root,
                 function = util.cmd,
                 fargs = {'cmdline': script.cmdline(), 'env':self.env},
@@ -4,9 +4,20 @@ import subprocess
 import tempfile
 import os.path
 import shutil
-import glob
 import signal
 import time
+import threading
+import multiprocessing
+import Queue
+import hashlib
+import cPickle
+import errno
+import fcntl
+import ctypes
+import ctypes.util
+import stat
+import select
+import pipes
 
 # This is only needed for Gentoo builds.
 try:
@@ -16,6 +27,28 @@ except ImportError:
 
 INHIBITOR_DEBUG = False
 
+# Set once this process is in a private mount namespace, see namespace.py.
+MOUNT_NAMESPACE = False
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+except OSError:
+    _libc = None
+
+try:
+    from os import scandir as _scandir
+except ImportError:
+    try:
+        from scandir import scandir as _scandir
+    except ImportError:
+        _scandir = None
+
+_libc_copy_file_range = getattr(_libc, 'copy_file_range', None)
+if _libc_copy_file_range != None:
+    _libc_copy_file_range.restype = ctypes.c_ssize_t
+    _libc_copy_file_range.argtypes = [ctypes.c_int, ctypes.c_void_p,
+        ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t, ctypes.c_uint]
+
 class InhibitorError(Exception):
     def __init__(self, message):
         super(InhibitorError, self).__init__(message)
@@ -89,10 +122,22 @@ class Step(Container):
     """
     Container for a function to be run, pairing it with the name of
     the action the function will be preforming.
+
+    @param function     - Function to run.
+    @param always       - Run the step even if its inputs have not changed.
+    @param conf_keys    - Keys of the action's configuration only this step
+                          and the steps after it depend on.
+    @param checkpoint   - Checkpoint the action's output after the step runs,
+                          for actions that support it (False).
+    @param resource     - What the step mostly uses, 'cpu', 'io' or 'mount'.
+                          Limits how many steps using it run at once when
+                          actions run concurrently (None).
     """
-    def __init__(self, function, always=True, **keywds):
+    def __init__(self, function, always=True, conf_keys=(), checkpoint=False,
+            resource=None, **keywds):
         self.function = types.FunctionType
-        super(Step, self).__init__(function=function, always=always, **keywds)
+        super(Step, self).__init__(function=function, always=always,
+            conf_keys=conf_keys, checkpoint=checkpoint, resource=resource, **keywds)
         self.name = function.func_name
 
     def run(self):
@@ -149,125 +194,420 @@ def umount(mp, mounts):
         mounts.remove( mp )
 
     fp = mp.root.pjoin(mp.dest)
-    if cmd('umount %s' % fp, raise_exception=False) != 0:
-        warn('Unmount of %s failed.' % fp)
-        warn('Killing any processes still running in %s' % mp.root)
-        pl = []
-        for root in glob.glob('/proc/[0-9][0-9]*/root'):
-            try:
-                if os.readlink(root).startswith(mp.root):
-                    pl.append( root[len('/proc/'):-len('/root')] )
-            except OSError, e:
-                # Catch the process having already exited.
-                if e.errno == 2:
-                    continue
-                raise
-        _kill_pids(pl)
-
-        if cmd('umount -f %s' % fp, raise_exception=False) != 0:
-            err('Cound not unmount %s' % fp)
-            return False
+    if not _teardown([fp], [mp.root]):
+        return False
     if mp.rmdir:
         shutil.rmtree(fp)
     return True
 
-
 def umount_all(mounts):
     """
-    Deactivate (unmount) all Mounts.
+    Deactivate (unmount) all Mounts, along with anything else mounted under
+    their roots.
 
     @param mounts   - List of mounts currently active.
     """
+    roots = []
+    for mp in mounts:
+        # Never sweep the host root, only what was mounted onto it.
+        if os.path.realpath(mp.root) == '/':
+            roots.append(mp.root.pjoin(mp.dest))
+        elif not mp.root in roots:
+            roots.append(mp.root)
+
+    ok = _teardown(roots, [mp.root for mp in mounts])
     mounts.reverse()
-    while len(mounts) > 0:
-        umount(mounts[0], mounts)
+    for mp in mounts:
+        fp = mp.root.pjoin(mp.dest)
+        if mp.rmdir and (ok or not os.path.ismount(fp)):
+            shutil.rmtree(fp, ignore_errors=True)
+    del mounts[:]
+    return ok
+
+def umount_under(path):
+    """
+    Unmount anything left mounted at or below path, such as the bind mounts
+    of an interrupted build, before path is removed.  Return False if anything
+    is still mounted there.
+    """
+    path = os.path.realpath(path)
+    if not [p for p in mount_points() if _path_under(p, path)]:
+        return True
+    warn('Unmounting what is left mounted under %s' % (path,))
+    return _teardown([path], [path])
+
+def _path_under(path, top):
+    """Return True if path is top or below it."""
+    top = top.rstrip('/')
+    return path == top or path.startswith(top + '/')
+
+def mount_points(mountinfo='/proc/self/mountinfo'):
+    """Return the mount points visible to this process, in mount order."""
+    ret = []
+    f = open(mountinfo)
+    try:
+        for line in f:
+            # Whitespace and backslashes in the path are octal escaped.
+            ret.append(line.split(' ', 5)[4].decode('string_escape'))
+    finally:
+        f.close()
+    return ret
+
+def proc_roots():
+    """Return a dictionary mapping the pid of every process to its root."""
+    roots = {}
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        try:
+            roots[int(pid)] = os.readlink('/proc/%s/root' % pid)
+        except OSError, e:
+            # Catch the process having already exited or belonging to a
+            # namespace we cannot look into.
+            if e.errno in (errno.ENOENT, errno.EACCES):
+                continue
+            raise
+    return roots
+
+def _umount_batch(paths, options=''):
+    """
+    Unmount paths, deepest first, with a single umount call.  Return the ones
+    that are still mounted afterwards.
+    """
+    if len(paths) == 0:
+        return []
+    cmd('umount %s %s' % (options, ' '.join([pipes.quote(p) for p in paths])),
+        raise_exception=False)
+    remaining = set(mount_points())
+    return [p for p in paths if p in remaining]
+
+def _teardown(tops, roots):
+    """
+    Unmount everything mounted at or below any path in tops, leaf first.  If
+    that fails, kill every process whose root is under any of roots and try
+    again.  Return False if anything is left mounted.
+    """
+    tops = [os.path.realpath(t) for t in tops]
+    roots = list(set([os.path.realpath(r) for r in roots]))
+
+    # Later mounts may be stacked on earlier ones at the same path, so keep
+    # each occurrence and unmount the newest first.
+    paths = [p for p in reversed(mount_points())
+        if [t for t in tops if _path_under(p, t)]]
+    paths.sort(key=lambda p: p.count('/'), reverse=True)
+
+    failed = _umount_batch(paths)
+    if len(failed) == 0:
+        return True
+
+    if MOUNT_NAMESPACE:
+        # Anything still using the mounts dies with the namespace, so there is
+        # no need to hunt it down.
+        warn('Unmount of %s failed, detaching.' % ', '.join(failed))
+        failed = _umount_batch(failed, '-l')
+    else:
+        warn('Unmount of %s failed.' % ', '.join(failed))
+        warn('Killing any processes still running in %s' % ', '.join(roots))
+        pids = [pid for pid, root in proc_roots().items()
+            if [r for r in roots if r != '/' and _path_under(root, r)]]
+        _kill_pids(pids)
+        failed = _umount_batch(failed, '-f')
+
+    for p in failed:
+        err('Cound not unmount %s' % p)
+    return len(failed) == 0
+
+# Seconds processes are given to exit after SIGTERM before they are killed.
+KILL_GRACE = 1.0
+
+def _pid_alive(pid):
+    """Return True if pid is running, reaping it if it is our child."""
+    try:
+        if os.waitpid(pid, os.WNOHANG)[0] == pid:
+            return False
+    except OSError, e:
+        if e.errno != errno.ECHILD:
+            raise
+    try:
+        f = open('/proc/%d/stat' % pid)
+        try:
+            data = f.read()
+        finally:
+            f.close()
+    except IOError:
+        return False
+    # The state follows the command name, which may itself contain spaces.
+    return not data[data.rindex(')') + 2] in 'ZX'
+
+def _signal_pids(pids, sig, ignore_exceptions):
+    for p in pids:
+        try:
+            os.kill(p, sig)
+        except OSError, e:
+            if e.errno == errno.ESRCH:
+                continue
+            if not ignore_exceptions:
+                raise
+            warn('Failed to kill %d' % (p,))
 
 def _kill_pids(pids, ignore_exceptions=True):
+    """
+    Send SIGTERM to all of pids at once, give them KILL_GRACE seconds to exit
+    and then SIGKILL whatever is left.
+    """
     if type(pids) == int:
         pids = [pids]
 
+    pids = set([int(p) for p in pids])
+    pids.discard(-1)
+    pids.discard(os.getpid())
+    pids = [p for p in pids if os.path.isdir('/proc/%d' % p)]
+    if len(pids) == 0:
+        return
+
+    _signal_pids(pids, signal.SIGTERM, ignore_exceptions)
+    deadline = time.time() + KILL_GRACE
+    delay = 0.005
+    while True:
+        pids = [p for p in pids if _pid_alive(p)]
+        if len(pids) == 0 or time.time() >= deadline:
+            break
+        time.sleep(delay)
+        delay = min(delay * 2, 0.1)
+
+    _signal_pids(pids, signal.SIGKILL, ignore_exceptions)
     for p in pids:
-        p = int(p)
-        if p == -1 or not os.path.isdir('/proc/%d' %p):
-            continue
         try:
-            os.kill(p, signal.SIGTERM)
-            time.sleep(0.1)
-            if os.waitpid(p, os.WNOHANG)[1] == 0:
-                os.kill(p, signal.SIGKILL)
-                os.waitpid(p, 0)
+            os.waitpid(p, 0)
         except OSError, e:
-            if os.path.isdir('/proc/%d') and ignore_exceptions:
-                warn('Failed to kill %d' % (p,))
-                pass
-            if not e.errno in (10, 3):
-                raise e
+            if e.errno != errno.ECHILD:
+                raise
 
-def _spawn(cmdline, env={}, return_output=False, timeout=0, exe=None, chdir=None):
-    if type(cmdline) == types.StringType:
-        cmdline = cmdline.split()
+# Bytes of command output kept in memory before spilling to a temporary file.
+OUTPUT_MEMORY_MAX = 8 * 1024 * 1024
 
-    if exe == None:
-        exe = cmdline[0]
+# Longest line of command output returned whole by Supervisor.lines().
+LINE_MAX = 64 * 1024
 
-    if return_output:
-        dbg("Getting output from '%s'" % ' '.join(cmdline))
-        fout = tempfile.NamedTemporaryFile()
-    else:
-        dbg("Calling '%s'" % ' '.join(cmdline))
-        fout = sys.stdout
+# pidfd_open(2), asm-generic/unistd.h
+_NR_PIDFD_OPEN = 434
 
-    try:
-        child = subprocess.Popen(cmdline, shell=False, executable=exe,
-            env=env, stdout=fout, stderr=subprocess.STDOUT, close_fds=True,
-            cwd=chdir)
-    except (SystemExit, KeyboardInterrupt):
-        _kill_pids(child.pid)
-        raise
-    except OSError, e:
-        raise InhibitorError("Failed to spawn '%s': %s" % (cmdline, e))
+def _pidfd_open(pid):
+    """Return a pidfd for pid or None if the kernel does not support them."""
+    if _libc == None:
+        return None
+    fd = _libc.syscall(_NR_PIDFD_OPEN, pid, 0)
+    if fd < 0:
+        return None
+    return fd
+
+class Supervisor(object):
+    """
+    Run a child process, collecting its output and enforcing an optional timeout.
+    Rather than polling on a fixed interval, the supervisor sleeps until the
+    child writes output or exits, using a pidfd to be woken on exit where the
+    kernel supports it.
+
+    @param cmdline      - List of arguments.
+    @param env          - Environment dictionary.  ({})
+    @param capture      - Collect output rather than passing it through to stdout.
+    @param timeout      - Seconds the child may run, 0 for no limit.  (0)
+    @param exe          - Executable to run, defaults to cmdline[0].
+    @param chdir        - Change to given directory before executing (None).
+    @param memory_max   - Bytes of output held in memory before spilling to a
+                          temporary file.  (OUTPUT_MEMORY_MAX)
+    """
+    def __init__(self, cmdline, env={}, capture=False, timeout=0, exe=None,
+            chdir=None, memory_max=None):
+        self.cmdline    = cmdline
+        self.env        = env
+        self.capture    = capture
+        self.timeout    = timeout
+        self.exe        = exe or cmdline[0]
+        self.chdir      = chdir
+        self.memory_max = memory_max or OUTPUT_MEMORY_MAX
+        self.child      = None
+        self.pidfd      = None
+        self.spool      = None
+        self.deadline   = None
+        self.returncode = None
+
+    def start(self):
+        """Start the child process."""
+        if self.capture:
+            dbg("Getting output from '%s'" % ' '.join(self.cmdline))
+            fout = subprocess.PIPE
+        else:
+            dbg("Calling '%s'" % ' '.join(self.cmdline))
+            fout = sys.stdout
 
-    if timeout == 0:
         try:
-            ret = child.wait()
-        except (SystemExit, KeyboardInterrupt):
-            raise InhibitorError(
-                "Caught SystemExit or KeyboardInterrupt while running %s"
-                % (cmdline))
-    else:
-        start_time = time.time()
-        ctime = start_time
+            self.child = subprocess.Popen(self.cmdline, shell=False,
+                executable=self.exe, env=self.env, stdout=fout,
+                stderr=subprocess.STDOUT, close_fds=True, cwd=self.chdir)
+        except OSError, e:
+            raise InhibitorError("Failed to spawn '%s': %s" % (self.cmdline, e))
+
+        if self.timeout:
+            self.deadline = time.time() + self.timeout
+        self.pidfd = _pidfd_open(self.child.pid)
+        return self
+
+    def _remaining(self):
+        """Milliseconds left before the deadline, None if there is no deadline."""
+        if self.deadline == None:
+            return None
+        remaining = self.deadline - time.time()
+        if remaining <= 0:
+            _kill_pids(self.child.pid)
+            raise InhibitorError("Timeout (%d seconds) waiting for '%s'"
+                % (int(self.timeout), self.cmdline))
+        return int(remaining * 1000) + 1
+
+    def _chunks(self):
+        """
+        Generator yielding output as the child writes it, if it is being captured,
+        until the child exits.  The exit status is then saved in returncode.
+        """
+        if not self.capture and self.deadline == None:
+            self.returncode = self.child.wait()
+            return
+
+        poller = select.poll()
+        pipe = None
+        if self.capture:
+            pipe = self.child.stdout.fileno()
+            poller.register(pipe, select.POLLIN | select.POLLHUP)
+        if self.pidfd != None:
+            poller.register(self.pidfd, select.POLLIN)
+
+        backoff = 1
         while True:
-            time.sleep(1)
-            ret = child.poll()
+            timeout = self._remaining()
+            if self.pidfd == None:
+                # Nothing wakes us when the child exits, so poll it with a backoff.
+                if timeout == None or timeout > backoff:
+                    timeout = backoff
+                backoff = min(backoff * 2, 100)
+
+            for fd, _ in poller.poll(timeout):
+                if fd != pipe:
+                    continue
+                data = os.read(pipe, 65536)
+                if data:
+                    yield data
+                    continue
+                poller.unregister(pipe)
+                pipe = None
+                if self.deadline == None:
+                    self.returncode = self.child.wait()
+                    return
+
+            ret = self.child.poll()
             if ret != None:
-                break
+                # Collect whatever output is left without waiting on any
+                # grandchildren that may still hold the pipe open.
+                while pipe != None and pipe in [fd for fd, _ in poller.poll(0)]:
+                    data = os.read(pipe, 65536)
+                    if not data:
+                        break
+                    yield data
+                self.returncode = ret
+                return
+
+    def _interrupted(self):
+        _kill_pids(self.child.pid)
+        raise InhibitorError(
+            "Caught SystemExit or KeyboardInterrupt while running %s"
+            % (self.cmdline))
+
+    def _close(self):
+        if self.pidfd != None:
+            os.close(self.pidfd)
+            self.pidfd = None
+        if self.capture:
+            self.child.stdout.close()
+
+    def wait(self):
+        """Wait for the child to exit, returning its exit status."""
+        if self.capture:
+            self.spool = tempfile.SpooledTemporaryFile(max_size=self.memory_max)
+        try:
+            for data in self._chunks():
+                self.spool.write(data)
+        except (SystemExit, KeyboardInterrupt):
+            self._interrupted()
+        finally:
+            self._close()
+        return self.returncode
+
+    def lines(self, max_line=LINE_MAX):
+        """
+        Generator yielding captured output a line at a time, without the trailing
+        newline, as soon as the child writes it.  Only one line is held in memory,
+        lines longer than max_line are returned in pieces.  Use instead of wait(),
+        the exit status is in returncode once the generator is exhausted.
+        """
+        buf = ''
+        try:
+            for data in self._chunks():
+                buf += data
+                start = 0
+                while True:
+                    end = buf.find('\n', start)
+                    if end == -1:
+                        break
+                    yield buf[start:end]
+                    start = end + 1
+                buf = buf[start:]
+                while len(buf) > max_line:
+                    yield buf[:max_line]
+                    buf = buf[max_line:]
+            if buf:
+                yield buf
+        except (SystemExit, KeyboardInterrupt):
+            self._interrupted()
+        finally:
+            if self.returncode == None:
+                # The caller stopped reading early.
+                _kill_pids(self.child.pid)
+            self._close()
+
+    def output(self):
+        """Return everything the child wrote, if it was captured."""
+        if self.spool == None:
+            return None
+        self.spool.seek(0)
+        ret = self.spool.read()
+        self.spool.close()
+        self.spool = None
+        return ret
 
-            ctime = time.time()
-            if (start_time + timeout) >= ctime:
-                _kill_pids(child.pid)
-                raise InhibitorError("Timeout (%d seconds) waiting for '%s'"
-                    % (int(timeout), cmdline))
+def _spawn(cmdline, env={}, return_output=False, timeout=0, exe=None, chdir=None):
+    if type(cmdline) == types.StringType:
+        cmdline = cmdline.split()
 
+    proc = Supervisor(cmdline, env=env, capture=return_output, timeout=timeout,
+        exe=exe, chdir=chdir)
+    ret = proc.start().wait()
     if return_output:
-        fout.flush()
-        fout.seek(0)
-        output = fout.read()
-        ret = (ret, output)
-        fout.close()
+        ret = (ret, proc.output())
     return ret
 
-def _spawn_sh(cmdline, env, chdir=None, return_output=False, shell='/bin/bash'):
+def _sh_args(cmdline, shell):
     args = [shell, '-c']
     if '|' in cmdline:
         # Make sure we get a real return value.
         cmdline = "set -o pipefail;" + cmdline
 
     args.append(cmdline)
+    return args
 
-    return _spawn(args, env, exe=shell, chdir=chdir, return_output=return_output)
+def _spawn_sh(cmdline, env, chdir=None, return_output=False, shell='/bin/bash', timeout=0):
+    return _spawn(_sh_args(cmdline, shell), env, exe=shell, chdir=chdir,
+        return_output=return_output, timeout=timeout)
 
-def cmd(cmdline, env={}, raise_exception=True, chdir=None, shell='/bin/bash'):
+def cmd(cmdline, env={}, raise_exception=True, chdir=None, shell='/bin/bash', timeout=0):
     """
     Call a command using bash.  If piping is detected, pipefail will be set.
 
@@ -276,6 +616,8 @@ def cmd(cmdline, env={}, raise_exception=True, chdir=None, shell='/bin/bash'):
     @param raise_exception  - Raise exception on non-zero return. (True)
     @param chdir            - Change to given directory before executing (None).
     @param shell            - Shell to run the command in (/bin/bash).
+    @param timeout          - Seconds to wait before killing the command, 0 to
+                              wait forever. (0)
 
     Return is the return code from the command.
     """
@@ -285,7 +627,7 @@ def cmd(cmdline, env={}, raise_exception=True, chdir=None, shell='/bin/bash'):
 
     try:
         sys.stdout.flush()
-        ret = _spawn_sh(cmdline, env, chdir=chdir, shell=shell)
+        ret = _spawn_sh(cmdline, env, chdir=chdir, shell=shell, timeout=timeout)
         if ret != 0:
             if raise_exception:
                 raise InhibitorError("'%s' returned %d" % (cmdline, ret))
@@ -293,7 +635,7 @@ def cmd(cmdline, env={}, raise_exception=True, chdir=None, shell='/bin/bash'):
         raise
     return ret
 
-def cmd_out(cmdline, env={}, raise_exception=True, chdir=None, shell='/bin/bash'):
+def cmd_out(cmdline, env={}, raise_exception=True, chdir=None, shell='/bin/bash', timeout=0):
     """
     Call a command using bash.  If piping is detected, pipefail will be set.
 
@@ -302,13 +644,16 @@ def cmd_out(cmdline, env={}, raise_exception=True, chdir=None, shell='/bin/bash'
     @param raise_exception  - Raise exception on non-zero return. (True)
     @param chdir            - Change to given directory before executing (None).
     @param shell            - Shell to run the command in (/bin/bash).
+    @param timeout          - Seconds to wait before killing the command, 0 to
+                              wait forever. (0)
 
     Return is a pair:  (return code, output)
     """
 
     try:
         sys.stdout.flush()
-        ret, out = _spawn_sh(cmdline, env, return_output=True, chdir=chdir, shell=shell)
+        ret, out = _spawn_sh(cmdline, env, return_output=True, chdir=chdir, shell=shell,
+            timeout=timeout)
         if ret != 0 and raise_exception:
             raise InhibitorError("'%s' returned %d, %s" % (cmdline, ret, out))
         if out.count('\n') <= 1:
@@ -317,6 +662,46 @@ def cmd_out(cmdline, env={}, raise_exception=True, chdir=None, shell='/bin/bash'
     except:
         raise
 
+class _CmdIter(object):
+    """Iterator returned by cmd_iter()."""
+    def __init__(self, cmdline, proc, raise_exception):
+        self.cmdline            = cmdline
+        self.proc               = proc
+        self.raise_exception    = raise_exception
+        self.returncode         = None
+
+    def __iter__(self):
+        for line in self.proc.lines():
+            yield line
+        self.returncode = self.proc.returncode
+        if self.returncode != 0 and self.raise_exception:
+            raise InhibitorError("'%s' returned %d" % (self.cmdline, self.returncode))
+
+def cmd_iter(cmdline, env={}, raise_exception=True, chdir=None, shell='/bin/bash', timeout=0):
+    """
+    Call a command using bash and iterate over its output a line at a time while
+    it runs.  If piping is detected, pipefail will be set.
+
+    @param cmdline          - Command to call, a string
+    @param env              - Environment dictionary.  ({})
+    @param raise_exception  - Raise exception on non-zero return. (True)
+    @param chdir            - Change to given directory before executing (None).
+    @param shell            - Shell to run the command in (/bin/bash).
+    @param timeout          - Seconds to wait before killing the command, 0 to
+                              wait forever. (0)
+
+    Return is an iterator over the lines of output, without trailing newlines.
+    Once it is exhausted, its returncode attribute is the return code from the
+    command.
+    """
+    if type(cmdline) != types.StringType:
+        raise InhibitorError("Invalid command line, not a string:  %s", (str(cmdline),))
+
+    sys.stdout.flush()
+    proc = Supervisor(_sh_args(cmdline, shell), env=env, capture=True,
+        timeout=timeout, exe=shell, chdir=chdir)
+    return _CmdIter(cmdline, proc.start(), raise_exception)
+
 def chroot(path, function, failuref=None, fargs={}, failure_args={}):
     """
     Run a function inside of a chroot.
@@ -362,6 +747,21 @@ def chroot(path, function, failuref=None, fargs={}, failure_args={}):
     os.chdir(orig_dir)
     return ret
 
+def unshare(flags):
+    """Disassociate parts of the process execution context, see unshare(2)."""
+    if _libc == None or _libc.unshare(flags) != 0:
+        e = ctypes.get_errno()
+        raise InhibitorError("unshare(0x%x) failed: %s" % (flags, os.strerror(e)))
+
+# prctl(2) option to signal a process when its parent exits.
+PR_SET_PDEATHSIG = 1
+
+def set_pdeathsig(sig):
+    """Have the kernel send sig to this process when its parent exits."""
+    if _libc == None or _libc.prctl(PR_SET_PDEATHSIG, sig, 0, 0, 0) != 0:
+        e = ctypes.get_errno()
+        raise InhibitorError("prctl(PR_SET_PDEATHSIG) failed: %s" % (os.strerror(e),))
+
 def make_conf_dict(path):
     """
     Read a make.conf file and return it as a dictionary.
@@ -393,10 +793,509 @@ def write_dict_bash(bd, path):
         f.write('%s="%s"\n' % (k, bd[k]))
     f.close()
 
-def path_sync(src, targ, root='/', ignore=lambda x, y: [], file_copy_callback=None):
+class _DirEntry(object):
+    """
+    Minimal stand in for the entries returned by scandir when neither os.scandir
+    nor the scandir module are available.  Stat results are cached the same way.
+    """
+    def __init__(self, dirpath, name):
+        self.name       = name
+        self.path       = os.path.join(dirpath, name)
+        self._lstat     = None
+        self._stat      = None
+
+    def _get_lstat(self):
+        if self._lstat == None:
+            self._lstat = os.lstat(self.path)
+        return self._lstat
+
+    def is_symlink(self):
+        try:
+            return stat.S_ISLNK(self._get_lstat().st_mode)
+        except OSError:
+            return False
+
+    def is_dir(self, follow_symlinks=True):
+        try:
+            return stat.S_ISDIR(self.stat(follow_symlinks=follow_symlinks).st_mode)
+        except OSError:
+            return False
+
+    def is_file(self, follow_symlinks=True):
+        try:
+            return stat.S_ISREG(self.stat(follow_symlinks=follow_symlinks).st_mode)
+        except OSError:
+            return False
+
+    def stat(self, follow_symlinks=True):
+        if follow_symlinks and self.is_symlink():
+            if self._stat == None:
+                self._stat = os.stat(self.path)
+            return self._stat
+        return self._get_lstat()
+
+def _scandir_fallback(path):
+    return [_DirEntry(path, name) for name in os.listdir(path)]
+
+if _scandir == None:
+    _scandir = _scandir_fallback
+
+def walk(top, ignore=None, follow_links=False):
+    """
+    Iterate over everything below top without recursing.  Entries are returned
+    depth first, each directory before its contents and the contents of a
+    directory in the order the filesystem lists them, the same order
+    os.listdir() would give.  The entries are scandir DirEntry objects, so
+    their stat results are cached.
+
+    @param top          - Directory to walk.
+    @param ignore       - Function given a directory and a list of names in it that
+                          returns the names to skip, see shutil.ignore_patterns.
+    @param follow_links - Walk into symlinks pointing at directories.  A link to
+                          one of its own parent directories is returned but not
+                          walked into.
+    """
+    stack = [iter(_walk_entries(top, ignore))]
+    ancestors = []
+    if follow_links:
+        st = os.stat(top)
+        ancestors.append((st.st_dev, st.st_ino))
+
+    while len(stack) > 0:
+        try:
+            entry = stack[-1].next()
+        except StopIteration:
+            stack.pop()
+            if follow_links:
+                ancestors.pop()
+            continue
+
+        yield entry
+
+        if entry.is_dir(follow_symlinks=follow_links):
+            if follow_links:
+                st = entry.stat()
+                if (st.st_dev, st.st_ino) in ancestors:
+                    continue
+                ancestors.append((st.st_dev, st.st_ino))
+            stack.append(iter(_walk_entries(entry.path, ignore)))
+
+def is_link_loop(path):
+    """Return True if the symlink path points at itself or one of its parents."""
+    real = os.path.realpath(path).rstrip('/') + '/'
+    parent = os.path.realpath(os.path.dirname(path)).rstrip('/') + '/'
+    return parent.startswith(real)
+
+def _walk_entries(path, ignore):
+    entries = list(_scandir(path))
+    if ignore != None:
+        ignored = ignore(path, [e.name for e in entries])
+        if ignored:
+            entries = [e for e in entries if not e.name in ignored]
+    return entries
+
+class DirCache(object):
+    """
+    Create directories, remembering which are known to exist so that repeated
+    requests for the same directory do not cost any system calls.
+    """
+    def __init__(self):
+        self.known = set()
+
+    def makedirs(self, path):
+        """Create path, following any symlinks in it, if it does not exist."""
+        if path in self.known:
+            return
+        real = os.path.realpath(path)
+        if not os.path.lexists(real):
+            try:
+                os.makedirs(real)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+        self.known.add(path)
+
+class _CopyPool(object):
+    """
+    Bounded pool of threads used by path_sync to copy regular files.  Finished
+    copies are handed back to the thread that owns the pool so that any
+    file_copy_callback is only ever called serially from that thread.
+
+    @param jobs     - Number of copy threads to run.  With a single job files
+                      are copied inline and no threads are started.
+    @param copier   - FileCopier used to copy each file.
+    """
+    def __init__(self, jobs, copier):
+        self.jobs       = max(1, jobs)
+        self.copier     = copier
+        self.pending    = Queue.Queue(self.jobs * 4)
+        self.done       = Queue.Queue()
+        self.threads    = []
+        self.queued     = 0
+        self.abort      = False
+
+    def _worker(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                return
+            src, targ, callback, st = item
+            if self.abort:
+                self.done.put((src, targ, callback, None))
+                continue
+            try:
+                self.copier.copy(src, targ, st)
+                self.done.put((src, targ, callback, None))
+            except Exception:
+                self.abort = True
+                self.done.put((src, targ, callback, sys.exc_info()))
+
+    def _finished(self, src, targ, callback, error):
+        self.queued -= 1
+        if error:
+            raise error[0], error[1], error[2]
+        if callback != None and not self.abort:
+            callback(src, targ)
+
+    def _drain(self, block=False):
+        while self.queued > 0:
+            try:
+                item = self.done.get(block)
+            except Queue.Empty:
+                return
+            self._finished(*item)
+
+    def copy(self, src, targ, callback=None, st=None):
+        """Queue src to be copied to targ, calling callback when finished."""
+        if self.jobs == 1:
+            self.copier.copy(src, targ, st)
+            if callback != None:
+                callback(src, targ)
+            return
+
+        if len(self.threads) < self.jobs:
+            t = threading.Thread(target=self._worker)
+            t.setDaemon(True)
+            t.start()
+            self.threads.append(t)
+
+        self.queued += 1
+        self.pending.put((src, targ, callback, st))
+        self._drain()
+
+    def join(self):
+        """Wait for all queued copies, re-raising the first failure."""
+        try:
+            self._drain(block=True)
+        finally:
+            self.close()
+
+    def close(self):
+        """Stop the copy threads, discarding any queued work."""
+        self.abort = True
+        for _ in self.threads:
+            self.pending.put(None)
+        for t in self.threads:
+            t.join()
+        self.threads = []
+
+class Manifest(object):
+    """
+    Record of the files path_sync has copied into a destination.  Used to skip
+    copying files that have not changed since the previous sync.  A file is
+    unchanged when the size, mtime and mode of both the source and the copy
+    match what was recorded when it was last copied.
+
+    @param path     - File the manifest is stored in.
+    @param checksum - Also record a sha1 of every file.  A source whose stat
+                      information changed but whose contents did not will only
+                      have its metadata updated instead of being copied.
+    """
+    def __init__(self, path, checksum=False):
+        self.path       = Path(path)
+        self.checksum   = checksum
+        self.entries    = {}
+        self.seen       = {}
+        self.lock       = threading.Lock()
+
+        if os.path.exists(self.path):
+            f = open(self.path, 'rb')
+            try:
+                self.entries = cPickle.load(f)
+            except (EOFError, ValueError, cPickle.UnpicklingError):
+                warn("Ignoring corrupt manifest %s" % (self.path,))
+            f.close()
+
+    def _stat_sig(self, path):
+        try:
+            st = os.lstat(path)
+        except OSError:
+            return None
+        return [st.st_size, st.st_mtime, st.st_mode]
+
+    def _digest(self, path):
+        return file_digest(path)
+
+    def unchanged(self, src, targ):
+        """Return True if targ is still an up to date copy of src."""
+        entry = self.entries.get(targ)
+        if entry == None:
+            return False
+
+        src_sig, targ_sig, digest = entry
+        if targ_sig != self._stat_sig(targ):
+            return False
+
+        cur_sig = self._stat_sig(src)
+        if cur_sig == src_sig:
+            self.lock.acquire()
+            self.seen[targ] = entry
+            self.lock.release()
+            return True
+
+        if (not self.checksum
+                or digest == None
+                or cur_sig == None
+                or cur_sig[0] != src_sig[0]
+                or self._digest(src) != digest ):
+            return False
+
+        shutil.copystat(src, targ)
+        self.record(src, targ, digest)
+        return True
+
+    def record(self, src, targ, digest=None):
+        """Record that src has just been copied to targ."""
+        if self.checksum and digest == None:
+            digest = self._digest(targ)
+        entry = [self._stat_sig(src), self._stat_sig(targ), digest]
+        self.lock.acquire()
+        self.seen[targ] = entry
+        self.lock.release()
+
+    def save(self):
+        """Write out the entries for every file seen since the manifest was loaded."""
+        mkdir(os.path.dirname(self.path))
+        tmp = '%s.%d.tmp' % (self.path, os.getpid())
+        f = open(tmp, 'wb')
+        cPickle.dump(self.seen, f, cPickle.HIGHEST_PROTOCOL)
+        f.close()
+        os.rename(tmp, self.path)
+
+class SyncStats(object):
+    """
+    Counters describing how path_sync moved files into place.
+
+    files   - Dictionary of backend name to the number of files it copied.
+    bytes   - Dictionary of backend name to the number of bytes it copied.
+    skipped - Number of files skipped as they were unchanged.
+    deduped - Number of symlink targets not synced again as they already had been.
+    """
+    def __init__(self):
+        self.files      = {}
+        self.bytes      = {}
+        self.skipped    = 0
+        self.deduped    = 0
+        self.lock       = threading.Lock()
+
+    def add(self, backend, nbytes):
+        self.lock.acquire()
+        self.files[backend] = self.files.get(backend, 0) + 1
+        self.bytes[backend] = self.bytes.get(backend, 0) + nbytes
+        self.lock.release()
+
+    def skip(self):
+        self.lock.acquire()
+        self.skipped += 1
+        self.lock.release()
+
+    def dedup(self):
+        self.lock.acquire()
+        self.deduped += 1
+        self.lock.release()
+
+    def __getstate__(self):
+        return (self.files, self.bytes, self.skipped, self.deduped)
+
+    def __setstate__(self, state):
+        self.files, self.bytes, self.skipped, self.deduped = state
+        self.lock = threading.Lock()
+
+    def __str__(self):
+        ret = []
+        for backend in COPY_BACKENDS:
+            if backend in self.files:
+                ret.append('%s: %d files, %d bytes' % (
+                    backend, self.files[backend], self.bytes[backend]))
+        if self.skipped:
+            ret.append('unchanged: %d files' % (self.skipped,))
+        if self.deduped:
+            ret.append('deduplicated: %d links' % (self.deduped,))
+        return ', '.join(ret) or 'nothing copied'
+
+# ioctl(2) request to share the extents of one file with another, linux/fs.h
+FICLONE = 0x40049409
+
+# Errors meaning a copy backend cannot be used between two filesystems.
+_UNSUPPORTED = (errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL,
+    errno.ENOSYS)
+
+# Errors meaning a copy backend cannot be used for one file, such as an
+# immutable source, the next backend is tried for it alone.
+_UNSUPPORTED_FILE = (errno.EPERM, errno.EBADF)
+
+# (source device, destination device), backend pairs found to be unsupported.
+_unsupported_backends = set()
+
+def _copy_reflink(src, targ):
+    fsrc = open(src, 'rb')
+    try:
+        fdst = open(targ, 'wb')
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        finally:
+            fdst.close()
+    finally:
+        fsrc.close()
+    shutil.copystat(src, targ)
+
+def _copy_file_range(src, targ):
+    if _libc_copy_file_range == None:
+        raise OSError(errno.ENOSYS, 'copy_file_range is not available')
+
+    fsrc = open(src, 'rb')
+    try:
+        fdst = open(targ, 'wb')
+        try:
+            size = os.fstat(fsrc.fileno()).st_size
+            remaining = size
+            while remaining > 0:
+                ret = _libc_copy_file_range(fsrc.fileno(), None, fdst.fileno(),
+                    None, min(remaining, 1 << 30), 0)
+                if ret < 0:
+                    e = ctypes.get_errno()
+                    raise OSError(e, os.strerror(e))
+                elif ret == 0 and remaining == size:
+                    # Some filesystems copy nothing rather than failing, such
+                    # as procfs or network filesystems on older kernels.
+                    shutil.copyfileobj(fsrc, fdst, 1 << 20)
+                    remaining = size - fdst.tell()
+                    break
+                elif ret == 0:
+                    break
+                remaining -= ret
+            if remaining > 0:
+                raise IOError(errno.EIO, "Short copy of %s to %s, %d of %d bytes"
+                    % (src, targ, size - remaining, size))
+        finally:
+            fdst.close()
+    finally:
+        fsrc.close()
+    shutil.copystat(src, targ)
+
+def _copy_hardlink(src, targ):
+    os.link(src, targ)
+
+def _copy_plain(src, targ):
+    shutil.copy2(src, targ)
+
+_COPY_FUNCTIONS = {
+    'reflink':          _copy_reflink,
+    'copy_file_range':  _copy_file_range,
+    'hardlink':         _copy_hardlink,
+    'copy':             _copy_plain,
+}
+
+# Backends tried, in order, when none is requested.
+COPY_BACKENDS = ('reflink', 'copy_file_range', 'hardlink', 'copy')
+_AUTO_BACKENDS = ('reflink', 'copy_file_range', 'copy')
+
+class FileCopier(object):
+    """
+    Copy single files using the cheapest method the filesystems involved support.
+    Backends that fail as unsupported are remembered per pair of source and
+    destination filesystems and the next backend is tried instead, ending with
+    a plain copy.
+
+    @param backend  - One of COPY_BACKENDS or 'auto' (the default) to try reflink,
+                      then copy_file_range and finally a plain copy.  'hardlink'
+                      must only be used for sources that are never modified in
+                      place, as the destination shares the source inode.
+    @param manifest - Manifest used to skip unchanged files (None).
+    """
+    def __init__(self, backend='auto', manifest=None):
+        if backend in (None, 'auto'):
+            self.backends = _AUTO_BACKENDS
+        elif backend in COPY_BACKENDS:
+            self.backends = (backend,) + tuple(
+                [b for b in _AUTO_BACKENDS if b != backend])
+        else:
+            raise InhibitorError("Unknown copy backend '%s'" % (backend,))
+
+        self.manifest   = manifest
+        self.stats      = SyncStats()
+        self.devices    = {}
+
+    def _device(self, path):
+        try:
+            return self.devices[path]
+        except KeyError:
+            dev = os.stat(path).st_dev
+            self.devices[path] = dev
+            return dev
+
+    def copy(self, src, targ, st=None):
+        """
+        Copy src to targ, preserving mode and timestamps.  st may be given if
+        the result of stat(src) is already known.
+        """
+        if self.manifest != None and self.manifest.unchanged(src, targ):
+            self.stats.skip()
+            return
+
+        if st == None:
+            st = os.stat(src)
+        try:
+            tst = os.lstat(targ)
+        except OSError:
+            tst = None
+
+        if tst != None and ( stat.S_ISLNK(tst.st_mode)
+                or (tst.st_dev, tst.st_ino) == (st.st_dev, st.st_ino)
+                or self.backends[0] == 'hardlink' ):
+            # shutil.copy2 follows links for the dest path and we never want
+            # to write through a hardlink back into the source.
+            os.unlink(targ)
+
+        devs = (st.st_dev, self._device(os.path.dirname(targ)))
+        for backend in self.backends:
+            if (devs, backend) in _unsupported_backends:
+                continue
+            try:
+                _COPY_FUNCTIONS[backend](src, targ)
+            except (IOError, OSError), e:
+                if backend == 'copy':
+                    raise
+                elif e.errno in _UNSUPPORTED:
+                    dbg("%s unsupported for %s: %s" % (backend, src, e))
+                    _unsupported_backends.add((devs, backend))
+                elif e.errno in _UNSUPPORTED_FILE:
+                    dbg("%s failed for %s: %s" % (backend, src, e))
+                else:
+                    raise
+                continue
+            self.stats.add(backend, st.st_size)
+            break
+
+        if self.manifest != None:
+            self.manifest.record(src, targ)
+
+def path_sync(src, targ, root='/', ignore=lambda x, y: [], file_copy_callback=None, jobs=None,
+        manifest=None, checksum=False, backend='auto'):
     """
     Sync one path to another precisely preserving the the layout of the source.  In
     particular if chroot works in the source, it will work identically in the target.
+    Regular files are copied by a pool of threads while the source is walked.
 
     @param src                  - Source path.
     @param targ                 - Destination path.
@@ -407,6 +1306,19 @@ def path_sync(src, targ, root='/', ignore=lambda x, y: [], file_copy_callback=No
                                   using shutil.ignore_patterns.
     @param file_copy_callback   - After copying a file, this function will be called
                                   with the arguments source path, destination path.
+                                  Calls are always made from the calling thread.
+    @param jobs                 - Number of files to copy concurrently.  Defaults to
+                                  the number of cpus.
+    @param manifest             - Path to a manifest of a previous sync to targ.  Files
+                                  that have not changed since then are not copied
+                                  again, but file_copy_callback is still called for
+                                  them.  The manifest is updated afterwards.
+    @param checksum             - Use content hashes as well as size, mtime and mode
+                                  to find unchanged files, see Manifest.
+    @param backend              - How to copy files, see FileCopier.  Defaults to
+                                  reflinks where supported.
+
+    Returns a SyncStats describing what was copied.
     """
     if type(ignore) == types.FunctionType:
         ignore_func = ignore
@@ -415,67 +1327,114 @@ def path_sync(src, targ, root='/', ignore=lambda x, y: [], file_copy_callback=No
     else:
         ignore_func = shutil.ignore_patterns(ignore)
 
-    if os.path.isdir(src):
-        if not os.path.isdir(targ):
-            os.makedirs(targ)
-        contents = os.listdir(src)
-        ignore_list = ignore_func(src, contents)
-        for f in contents:
-            if f in ignore_list:
-                continue
-            path_sync(
-                os.path.join(src, f),
-                os.path.join(targ, f),
-                ignore=ignore_func,
-                root=root,
-                file_copy_callback=file_copy_callback
-            )
-    elif os.path.islink(src):
-        link = os.readlink(src)
-        if not os.path.lexists( os.path.dirname(os.path.realpath(targ)) ):
-            os.makedirs( os.path.dirname(os.path.realpath(targ)) )
-
-        if os.path.lexists(targ):
-            os.unlink(targ)
-        os.symlink(link, targ)
-
-        if link.startswith('/'):
-            # This is tricky.  We want to follow the link and copy the contents
-            # of whatever it points to.  However, as we may be building up a new
-            # root filesystem, links that start with / cannot be trusted, so we
-            # have to backtrack from the src path to what / actually is.
-            append = ''
-            for _ in range(0, src.count('/')-root.count('/')):
-                append = os.path.join(append, '..')
-
-            link = link.lstrip('/')
-            src = os.path.normpath( os.path.join( os.path.dirname(src), append, link) )
-            targ = os.path.normpath( os.path.join( os.path.dirname(targ), append, link) )
-
-            if os.path.exists(src):
-                path_sync( src, targ,
-                    ignore=ignore_func,
-                    root=root,
-                    file_copy_callback=file_copy_callback
-                )
+    if jobs == None:
+        jobs = cpu_count()
+    if not os.path.isdir(src):
+        jobs = 1
+
+    if manifest != None:
+        manifest = Manifest(manifest, checksum=checksum)
+
+    copier = FileCopier(backend, manifest=manifest)
+    pool = _CopyPool(jobs, copier)
+    try:
+        _path_sync(src, targ, root, ignore_func, file_copy_callback, pool)
+        pool.join()
+    finally:
+        pool.close()
+
+    if manifest != None:
+        manifest.save()
+    dbg("Synced %s to %s (%s)" % (src, targ, copier.stats))
+    return copier.stats
+
+def _path_sync(src, targ, root, ignore_func, file_copy_callback, pool):
+    dirs = DirCache()
+    work = [(src, targ)]
+    # Symlinks are followed by adding their target to the work list.  Every
+    # file and directory synced is recorded by its inode and the real path of
+    # its target, anything already synced to the same place is skipped, which
+    # also breaks loops.
+    visited = set()
+    # Real path of each target directory walked into.
+    realdirs = {}
+
+    def real_target(path):
+        parent, name = os.path.split(path)
+        if not parent in realdirs:
+            realdirs[parent] = os.path.realpath(parent)
+        return os.path.join(realdirs[parent], name)
+
+    while len(work) > 0:
+        src, targ = work.pop()
+
+        try:
+            st = os.stat(src)
+            key = (st.st_dev, st.st_ino, os.path.realpath(targ))
+        except OSError:
+            key = None
+        if key in visited:
+            pool.copier.stats.dedup()
+            continue
+        visited.add(key)
+
+        if os.path.isdir(src):
+            dirs.makedirs(targ)
+            prefix = len(src.rstrip('/')) + 1
+            for entry in walk(src, ignore=ignore_func, follow_links=True):
+                entry_targ = os.path.join(targ, entry.path[prefix:])
+                if entry.is_dir() and not (entry.is_symlink() and is_link_loop(entry.path)):
+                    dirs.makedirs(entry_targ)
+                    est = entry.stat()
+                    visited.add((est.st_dev, est.st_ino, real_target(entry_targ)))
+                elif entry.is_symlink():
+                    _sync_link(entry.path, entry_targ, root, dirs, work)
+                else:
+                    est = entry.stat()
+                    ekey = (est.st_dev, est.st_ino, real_target(entry_targ))
+                    if ekey in visited:
+                        pool.copier.stats.dedup()
+                        continue
+                    visited.add(ekey)
+                    dirs.makedirs(os.path.dirname(entry_targ))
+                    pool.copy(entry.path, entry_targ, file_copy_callback, est)
+        elif os.path.islink(src):
+            _sync_link(src, targ, root, dirs, work)
         else:
-            if os.path.exists(src):
-                path_sync(
-                    os.path.join(os.path.dirname(src), link),
-                    os.path.join(os.path.dirname(targ), link),
-                    ignore = ignore_func,
-                    root=root,
-                    file_copy_callback=file_copy_callback
-                 )
+            dirs.makedirs(os.path.dirname(targ))
+            pool.copy(src, targ, file_copy_callback)
+
+def _sync_link(src, targ, root, dirs, work):
+    link = os.readlink(src)
+    dirs.makedirs(os.path.dirname(targ))
+    try:
+        os.unlink(targ)
+    except OSError, e:
+        if e.errno != errno.ENOENT:
+            raise
+    os.symlink(link, targ)
+
+    if link.startswith('/'):
+        # This is tricky.  We want to follow the link and copy the contents
+        # of whatever it points to.  However, as we may be building up a new
+        # root filesystem, links that start with / cannot be trusted, so we
+        # have to backtrack from the src path to what / actually is.
+        append = ''
+        for _ in range(0, src.count('/')-root.count('/')):
+            append = os.path.join(append, '..')
+
+        link = link.lstrip('/')
+        src = os.path.normpath( os.path.join( os.path.dirname(src), append, link) )
+        targ = os.path.normpath( os.path.join( os.path.dirname(targ), append, link) )
+
+        if os.path.exists(src):
+            work.append((src, targ))
     else:
-        if not os.path.lexists( os.path.dirname(os.path.realpath(targ)) ):
-            os.makedirs( os.path.dirname(os.path.realpath(targ)) )
-        if os.path.islink(targ):
-            # shutil.copy2 follows links for the dest path.
-            os.unlink(targ)
-        shutil.copy2(src, targ)
-        if file_copy_callback != None:
-            file_copy_callback(src, targ)
+        if os.path.exists(src):
+            work.append((
+                os.path.join(os.path.dirname(src), link),
+                os.path.join(os.path.dirname(targ), link),
+            ))
 
 def strlist_to_list( strlist ):
     """
@@ -490,6 +1449,121 @@ def strlist_to_list( strlist ):
         raise InhibitorError("Cannot convert object to list.  %s" % (strlist,))
     return ret
 
+def cpu_count():
+    """Return the number of cpus on this host, or 1 if it cannot be found."""
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+def mem_total():
+    """Return the memory of this host in kB, or 0 if it cannot be found."""
+    try:
+        f = open('/proc/meminfo')
+    except IOError:
+        return 0
+    try:
+        for line in f:
+            if line.startswith('MemTotal:'):
+                return int(line.split()[1])
+    finally:
+        f.close()
+    return 0
+
+def which(program):
+    """Return the full path of program if it is found in PATH, otherwise None."""
+    for d in os.environ.get('PATH', os.defpath).split(os.pathsep):
+        path = os.path.join(d, program)
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            return path
+    return None
+
+def file_digest(path):
+    """Return the sha1 hex digest of the contents of path."""
+    h = hashlib.sha1()
+    f = open(path, 'rb')
+    try:
+        while True:
+            buf = f.read(1024*1024)
+            if not buf:
+                break
+            h.update(buf)
+    finally:
+        f.close()
+    return h.hexdigest()
+
+def fingerprint(*objs):
+    """
+    Return a sha1 hex digest identifying objs.  Lists, tuples, dictionaries and
+    Containers are walked, objects with an identity() method, like sources and
+    actions, are represented by what it returns, functions by their name and
+    code and anything else by its repr().
+    """
+    h = hashlib.sha1()
+    _fingerprint_update(h, objs)
+    return h.hexdigest()
+
+def _fingerprint_update(h, obj):
+    if hasattr(obj, 'identity'):
+        h.update('I')
+        _fingerprint_update(h, obj.identity())
+    elif isinstance(obj, Container):
+        keys = sorted(set(obj.keys))
+        h.update('C%d:' % len(keys))
+        for k in keys:
+            _fingerprint_update(h, k)
+            _fingerprint_update(h, getattr(obj, k))
+    elif type(obj) in (types.ListType, types.TupleType):
+        h.update('L%d:' % len(obj))
+        for o in obj:
+            _fingerprint_update(h, o)
+    elif type(obj) == types.DictType:
+        h.update('D%d:' % len(obj))
+        for k in sorted(obj.keys()):
+            _fingerprint_update(h, k)
+            _fingerprint_update(h, obj[k])
+    elif type(obj) == types.FunctionType:
+        h.update('F%s.%s:' % (obj.__module__, obj.func_name))
+        h.update(obj.func_code.co_code)
+        _fingerprint_update(h, [c for c in obj.func_code.co_consts
+            if type(c) != types.CodeType])
+    elif isinstance(obj, types.StringTypes):
+        h.update('S%d:' % len(obj))
+        h.update(obj.encode('utf-8') if type(obj) == types.UnicodeType else obj)
+    else:
+        h.update('R%s;' % repr(obj))
+
+def tree_identity(path, ignore=None, checksum=False):
+    """
+    Return a sha1 hex digest of the names, types, modes, sizes and modification
+    times of path and everything below it, or of their contents if checksum is
+    set, so that changing anything in the tree changes the digest.
+
+    @param path     - File or directory to identify.
+    @param ignore   - Function given a directory and a list of names in it that
+                      returns the names to skip, see shutil.ignore_patterns.
+    @param checksum - Hash the contents of files rather than their sizes and
+                      modification times.
+    """
+    h = hashlib.sha1()
+    def update(p, name, st):
+        h.update('%s\0%o' % (name, st.st_mode))
+        if stat.S_ISLNK(st.st_mode):
+            h.update(os.readlink(p))
+        elif stat.S_ISREG(st.st_mode):
+            if checksum:
+                h.update(file_digest(p))
+            else:
+                h.update('%d %r' % (st.st_size, st.st_mtime))
+        h.update('\0')
+
+    update(path, '', os.lstat(path))
+    if os.path.isdir(path) and not os.path.islink(path):
+        prefix = len(path.rstrip('/')) + 1
+        for entry in walk(path, ignore=ignore):
+            update(entry.path, entry.path[prefix:], entry.stat(follow_symlinks=False))
+    return h.hexdigest()
+
 def mkdir( path ):
     """
     Create a directory if it does not already exist.
@@ -61,6 +61,136 @@ init() {
 
 
 
+# emerge options whose argument may be given as the next word.
+_EMERGE_ARG_OPTS="--backtrack --buildpkg-exclude --color --config-root --exclude
+    --prefix --rebuild-exclude --rebuild-ignore --reinstall-atoms --root --sysroot
+    --usepkg-exclude --useoldpkg-atoms --with-bdeps --with-test-deps"
+
+# Split emerge arguments into _EMERGE_OPTS, options along with their arguments,
+# and _EMERGE_ATOMS, the atoms to record in world.  Sets _EMERGE_ONESHOT and
+# _EMERGE_JOBS to the number of jobs asked for, 0 for no limit, or empty.
+_parse_emerge_args() {
+    local arg value flags
+    _EMERGE_OPTS=()
+    _EMERGE_ATOMS=()
+    _EMERGE_ONESHOT=false
+    _EMERGE_JOBS=
+
+    while [ $# -gt 0 ]; do
+        arg=$1
+        shift
+        case "${arg}" in
+            --*=*)
+                _EMERGE_OPTS+=("${arg}")
+                [[ ${arg} == --jobs=* ]] && _EMERGE_JOBS=${arg#--jobs=}
+                ;;
+            --*)
+                value=
+                if [[ " "${_EMERGE_ARG_OPTS}" " == *[[:space:]]"${arg}"[[:space:]]* ]]; then
+                    value=$1
+                    shift
+                elif [[ $1 =~ ^([yn]|True|False|rdeps|[0-9]+(\.[0-9]+)?)$ ]]; then
+                    # Optional arguments such as --jobs 4 or --usepkg y.
+                    value=$1
+                    shift
+                fi
+                _EMERGE_OPTS+=("${arg}" ${value:+"${value}"})
+                case "${arg}" in
+                    --oneshot)  _EMERGE_ONESHOT=true;;
+                    --jobs)     _EMERGE_JOBS=${value:-0};;
+                esac
+                ;;
+            -*)
+                # Short options, -j and -l take an optional number either
+                # attached or as the next word.
+                value=
+                if [[ ${arg} == *[jl] && $1 =~ ^[0-9]+(\.[0-9]+)?$ ]]; then
+                    value=$1
+                    shift
+                fi
+                _EMERGE_OPTS+=("${arg}" ${value:+"${value}"})
+                flags=${arg#-}
+                if [[ ${flags} =~ j([0-9]*) ]]; then
+                    _EMERGE_JOBS=${BASH_REMATCH[1]}
+                    [[ ${flags} == *j ]] && _EMERGE_JOBS=${value}
+                    _EMERGE_JOBS=${_EMERGE_JOBS:-0}
+                fi
+                flags=$(echo "${flags}" | sed 's/[jl][0-9.]*//g')
+                [[ ${flags} == *1* ]] && _EMERGE_ONESHOT=true
+                ;;
+            system|world|@*)
+                ;;
+            *)
+                _EMERGE_ATOMS+=("${arg}")
+                ;;
+        esac
+    done
+}
+
+# Resolve the merge list for the emerge arguments once, log it and merge
+# exactly those packages without resolving their dependencies again.  With
+# more than one job, from the arguments or EMERGE_DEFAULT_OPTS, the list is
+# resolved and merged by a single emerge instead.  Sets _EMERGE_BLOCKED and
+# merges nothing if the list has blockers, which only the full resolver can
+# sort out.
+_emerge_resolved() {
+    local arg out rc jobs
+    local oneshot=false
+    local parallel=false
+    local -a opts=() atoms=() cpvs=()
+
+    _EMERGE_BLOCKED=false
+    if [ -x /usr/bin/portageq ]; then
+        _parse_emerge_args $(portageq envvar EMERGE_DEFAULT_OPTS 2>/dev/null)
+        jobs=${_EMERGE_JOBS}
+    fi
+    _parse_emerge_args $*
+    opts=("${_EMERGE_OPTS[@]}")
+    atoms=("${_EMERGE_ATOMS[@]}")
+    oneshot=${_EMERGE_ONESHOT}
+    jobs=${_EMERGE_JOBS:-${jobs}}
+    [ -n "${jobs}" ] && [ "${jobs}" != 1 ] && parallel=true
+
+    if ${parallel}; then
+        # Parallel jobs need the dependencies between the packages, which
+        # merging the list with --nodeps would drop, so portage merges what
+        # it resolves itself.
+        emerge --quiet --nospinner --buildpkg --usepkg $*
+        return $?
+    fi
+
+    out=$(emerge --pretend --quiet --color=n --nospinner --buildpkg --usepkg $*)
+    rc=$?
+    echo "${out}"
+    [ ${rc} -ne 0 ] && return ${rc}
+
+    if echo "${out}" | egrep -q '^\[(blocks|uninstall)'; then
+        ewarn "Blockers in the merge list, resolving again to merge"
+        _EMERGE_BLOCKED=true
+        return 0
+    fi
+
+    cpvs=( $(echo "${out}" \
+        | sed -n 's/^\[\(ebuild\|binary\)[^]]*\] *\([^ ]*\).*/=\2/p' \
+        | sed 's/::.*//') )
+    if [ ${#cpvs[@]} -eq 0 ]; then
+        einfo "Nothing to merge"
+    else
+        einfo "Merging ${#cpvs[@]} package(s):"
+        for arg in "${cpvs[@]}"; do
+            einfo "    ${arg#=}"
+        done
+        emerge --quiet --nospinner --buildpkg --usepkg --oneshot --nodeps \
+            "${opts[@]}" "${cpvs[@]}" || return $?
+    fi
+
+    # Record the requested atoms in world, as the full merge would have.
+    if ! ${oneshot} && [ ${#atoms[@]} -gt 0 ]; then
+        emerge --quiet --nospinner --noreplace --nodeps "${atoms[@]}" || return $?
+    fi
+    return 0
+}
+
 _run_emerge() {
     local i
     local rc
@@ -74,6 +204,24 @@ _run_emerge() {
     export CONFIG_PROTECT="-*"
 
     DIE_ON_FAIL=${DIE_ON_FAIL:-1}
+    RESOLVE_ONCE=${RESOLVE_ONCE:-1}
+
+    if [ ${RESOLVE_ONCE} -ne 0 ]; then
+        _emerge_resolved $*
+        rc=$?
+        if [ ${rc} -eq 0 ] && ${_EMERGE_BLOCKED}; then
+            emerge --quiet --nospinner --buildpkg --usepkg $*
+            rc=$?
+        fi
+        if [ ${rc} -ne 0 ]; then
+            if [ ${DIE_ON_FAIL} -eq 0 ]; then
+                die "emerge failed"
+            else
+                return ${rc}
+            fi
+        fi
+        return 0
+    fi
 
     for i in "--pretend --verbose" "--quiet"; do
         emerge ${i} --nospinner --buildpkg --usepkg $*
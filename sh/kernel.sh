@@ -12,7 +12,9 @@ install_kernel() {
     pushd "${KROOT}"/usr/src/linux-${KERNEL_RELEASE} &>/dev/null    || die "Failed to cd to kernel source"
     cp ${KERNEL_KCONFIG} .config                                    || die "Failed to copy kconfig"
     einfo "Building kernel"
-    make $(portageq envvar / MAKEOPTS)                              || die "Kernel build failed"
+    local makeopts=$(portageq envvar / MAKEOPTS)
+    [ -n "${KERNEL_JOBS}" ] && makeopts="-j${KERNEL_JOBS}"
+    make ${makeopts}                                                || die "Kernel build failed"
     einfo "Installing kernel"
 
     # mkboot (called by installkernel) likes grub-install to exist.
@@ -177,8 +179,20 @@ install_tarball() {
 }
 
 GENKERNEL=""
+BUILD_ONLY=false
+CHECK_CACHED=false
+KERNEL_JOBS=""
 while [ $# -gt 0 ]; do
     case $1 in
+        --build_only)
+            BUILD_ONLY=true
+            ;;
+        --check_cached)
+            CHECK_CACHED=true
+            ;;
+        --jobs)
+            shift;KERNEL_JOBS=${1}
+            ;;
         --kernel_pkg)
             shift;KERNEL_PKG=${1}
             ;;
@@ -197,11 +211,15 @@ if [ -z "${KERNEL_PKG}" ]; then
 fi
 
 init
+# Only report whether the kernel cache holds a build of this kernel.
+${CHECK_CACHED} && { cached; exit $?; }
 if ! cached; then
     einfo "No cached kernel build found..."
     install_kernel
     [ -n "${GENKERNEL}" ] && install_initramfs
     create_tarball
 fi
+# Only fill the kernel cache, installing it is left to a later run.
+${BUILD_ONLY} && exit 0
 install_tarball
 post_kern_merge
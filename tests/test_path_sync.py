@@ -0,0 +1,54 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from inhibitor import util
+
+class PathSyncTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmpdir, 'src')
+        self.out = os.path.join(self.tmpdir, 'out')
+        os.makedirs(os.path.join(self.src, 'lib'))
+        os.makedirs(os.path.join(self.src, 'a'))
+        f = open(os.path.join(self.src, 'lib', 'libz.so.1.2'), 'w')
+        f.write('libz')
+        f.close()
+        os.symlink('libz.so.1.2', os.path.join(self.src, 'lib', 'libz.so.1'))
+        for name in ('l1', 'l2', 'l3'):
+            os.symlink('/lib/libz.so.1.2', os.path.join(self.src, 'a', name))
+        self.copied = []
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def callback(self, src, targ):
+        self.copied.append(targ)
+
+    def sync(self):
+        util.path_sync(self.src, self.out, root=self.src,
+            file_copy_callback=self.callback, jobs=2)
+
+    def test_link_targets_copied_once(self):
+        self.sync()
+        self.assertEqual(self.copied, [os.path.join(self.out, 'lib', 'libz.so.1.2')])
+        self.assertEqual(os.readlink(os.path.join(self.out, 'a', 'l1')), '/lib/libz.so.1.2')
+
+    def test_loop_links_copied_once(self):
+        os.makedirs(os.path.join(self.src, 'b', 'c'))
+        f = open(os.path.join(self.src, 'b', 'c', 'file'), 'w')
+        f.close()
+        os.symlink('..', os.path.join(self.src, 'b', 'c', 'up'))
+        self.sync()
+        targets = [t for t in self.copied if t.endswith('/file')]
+        self.assertEqual(targets, [os.path.join(self.out, 'b', 'c', 'file')])
+
+    def test_each_target_called_back_once(self):
+        os.symlink('lib', os.path.join(self.src, 'lib64'))
+        os.symlink('../lib64/libz.so.1', os.path.join(self.src, 'a', 'l4'))
+        self.sync()
+        self.assertEqual(len(self.copied), len(set(self.copied)))
+
+if __name__ == '__main__':
+    unittest.main()